@@ -0,0 +1,183 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+import numpy as np
+import simulate_keywords
+import search
+import metrics
+from google_client import GoogleClient
+from rate_limiter import RequestScheduler
+from stub_server import StubServer
+
+
+"""
+Scheduler that also records how long every attempt at a request took
+"""
+class TimedScheduler(RequestScheduler):
+
+    def __init__(self, *args, **kwargs):
+        super(TimedScheduler, self).__init__(*args, **kwargs)
+        self.latencies = []
+        self._latency_lock = threading.Lock()
+
+
+    def execute(self, request, endpoint="unknown"):
+        def timed_request():
+            start = time.perf_counter()
+            try:
+                return request()
+            finally:
+                with self._latency_lock:
+                    self.latencies.append(time.perf_counter() - start)
+        return super(TimedScheduler, self).execute(timed_request, endpoint)
+
+
+"""
+Site search fetcher that also records how long every Custom Search request took, the pool's retries included
+(those are counted in search_retries_total)
+"""
+class TimedFetcher(search.SiteSearchFetcher):
+
+    def __init__(self, *args, **kwargs):
+        super(TimedFetcher, self).__init__(*args, **kwargs)
+        self.latencies = []
+        self._latency_lock = threading.Lock()
+
+
+    def _request(self, params):
+        start = time.perf_counter()
+        try:
+            return super(TimedFetcher, self)._request(params)
+        finally:
+            with self._latency_lock:
+                self.latencies.append(time.perf_counter() - start)
+
+
+"""
+Run STAGE and report wall time, calls served by the stub, calls/sec, latency percentiles and retries,
+of both the Trends requests (through SCHEDULER) and the Custom Search requests (through FETCHER)
+"""
+def measure(name, stage, stub, scheduler, fetcher):
+    requests_before = sum(stub.stats()["requests"].values())
+    latencies_before = len(scheduler.latencies), len(fetcher.latencies)
+    retries_before = scheduler.stats()["retries"] + metrics.REGISTRY.total("search_retries_total")
+    errors_before = sum(stub.stats()["errors"].values())
+
+    start = time.perf_counter()
+    stage()
+    wall = time.perf_counter() - start
+
+    calls = sum(stub.stats()["requests"].values()) - requests_before
+    latencies = scheduler.latencies[latencies_before[0]:] + fetcher.latencies[latencies_before[1]:]
+    retries = scheduler.stats()["retries"] + metrics.REGISTRY.total("search_retries_total") - retries_before
+    return {
+        "stage": name,
+        "wall_seconds": wall,
+        "calls": calls,
+        "calls_per_second": calls / wall if wall > 0 else 0.0,
+        "p50_ms": float(np.percentile(latencies, 50) * 1000) if latencies else None,
+        "p99_ms": float(np.percentile(latencies, 99) * 1000) if latencies else None,
+        "retries": retries,
+        "errors_injected": sum(stub.stats()["errors"].values()) - errors_before,
+    }
+
+
+"""
+Run keyword generation, relative search volumes and site search end to end against a local stub server
+"""
+def run_benchmark(initial_search_term="food banks near me", geo_code="US", latency=0.05, jitter=0.0, error_rate=0.0,
+                  replay_file=None, rate=1000.0, max_depth=simulate_keywords.Simulation.MAX_DEPTH):
+    geoLocation = {"code": geo_code, "description": geo_code}
+    stub = StubServer(latency=latency, jitter=jitter, error_rate=error_rate, retry_after=0.1, replay_file=replay_file)
+    with stub:
+        scheduler = TimedScheduler(rate=rate, max_attempts=10, base_delay=0.05, max_delay=1.0)
+        google_client = GoogleClient(stub.url, simulate_keywords.Simulation.TRENDS_VERSION, scheduler=scheduler)
+        fetcher = TimedFetcher(search_url=stub.url + "/customsearch/v1", quota_path=None)
+        simulation = simulate_keywords.Simulation(
+            initial_search_term, geoLocation, "2020-01", "2020-08", "2020-01-01", "2020-08-31",
+            google_client=google_client
+        )
+        return [
+            measure("generate_keywords", lambda: simulation.generate_keywords(max_depth=max_depth), stub, scheduler, fetcher),
+            measure("get_relative_search_volumes", simulation.get_relative_search_volumes, stub, scheduler, fetcher),
+            measure("search.main", lambda: search.main(
+                simulation.relative_search_volumes, initial_search_term, fetcher=fetcher
+            ), stub, scheduler, fetcher),
+        ]
+
+
+def print_results(results):
+    print("{:<30}{:>10}{:>8}{:>10}{:>10}{:>10}{:>9}".format("stage", "wall (s)", "calls", "calls/s", "p50 (ms)", "p99 (ms)", "retries"))
+    for result in results:
+        print("{:<30}{:>10.2f}{:>8}{:>10.1f}{:>10}{:>10}{:>9}".format(
+            result["stage"], result["wall_seconds"], result["calls"], result["calls_per_second"],
+            "-" if result["p50_ms"] is None else "{:.1f}".format(result["p50_ms"]),
+            "-" if result["p99_ms"] is None else "{:.1f}".format(result["p99_ms"]),
+            result["retries"]
+        ))
+
+
+"""
+Stages whose wall time grew by more than TOLERANCE compared to BASELINE
+"""
+def regressions(results, baseline, tolerance):
+    previous = dict((result["stage"], result) for result in baseline)
+    slower = []
+    for result in results:
+        before = previous.get(result["stage"])
+        if before and result["wall_seconds"] > before["wall_seconds"] * (1 + tolerance):
+            slower.append((result["stage"], before["wall_seconds"], result["wall_seconds"]))
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the simulation against a local stub server")
+    parser.add_argument("--term", default="food banks near me")
+    parser.add_argument("--geo", default="US")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds the stub waits before answering")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 429/503")
+    parser.add_argument("--replay", default=None, help="jsonl file of recorded responses, see stub_server.py")
+    parser.add_argument("--rate", type=float, default=1000.0, help="token bucket rate in requests per second")
+    parser.add_argument("--max-depth", type=int, default=simulate_keywords.Simulation.MAX_DEPTH)
+    parser.add_argument("--json", default=None, help="write the results to this file")
+    parser.add_argument("--baseline", default=None, help="results file of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed wall time increase over the baseline")
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+
+    replay = os.path.abspath(args.replay) if args.replay else None
+    baseline = os.path.abspath(args.baseline) if args.baseline else None
+    output = os.path.abspath(args.json) if args.json else None
+
+    # Run in a scratch directory so the benchmark never touches real output, cache or log files
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as scratch:
+        os.chdir(scratch)
+        try:
+            results = run_benchmark(
+                args.term, args.geo, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                replay_file=replay, rate=args.rate, max_depth=args.max_depth
+            )
+        finally:
+            os.chdir(cwd)
+
+    print_results(results)
+    if output:
+        with open(output, "w") as results_file:
+            json.dump(results, results_file, indent=2)
+    if baseline:
+        with open(baseline, "r") as baseline_file:
+            slower = regressions(results, json.load(baseline_file), args.tolerance)
+        for stage, before, after in slower:
+            print("REGRESSION: {} took {:.2f}s, baseline {:.2f}s".format(stage, after, before))
+        if slower:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,31 +1,181 @@
 import sys
 import os
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build_from_document
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from googleapiclient.errors import HttpError
 import simulate_keywords
+from response_cache import CacheMiss, ResponseCache, is_closed_window
+from single_flight import SingleFlight
+from rate_limiter import RequestScheduler, CallBudget
+from timeline_store import parse_timeline_date, TimelineTensor
+import metrics
+import log_setup
 import logging
-import time
-import copy
 import json
+import datetime
+import threading
+import httplib2
+import numpy as np
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+
+# Discovery documents are parsed once per process and services are built once per thread,
+# then reused by every GoogleClient talking to the same server
+_discovery_documents = dict()
+_discovery_lock = threading.Lock()
+_thread_services = threading.local()
 
 class GoogleClient(object):
+    TIMELINE_BATCH_SIZE = 30 # Most terms getTimelinesForHealth accepts in one request
+    TIMELINE_WORKERS = 8 # Timeline batches requested at the same time
+    DISCOVERY_DIR = "cache/discovery" # Discovery documents are stored here after the first fetch
+    TIMELINE_SHARD_DAYS = 365 # Longer timeline ranges are requested as windows of this many days
+    TIMELINE_OVERLAP_DAYS = 28 # Days each window reaches back into the previous one, to rescale on
 
-    def __init__(self, trends_server, trends_version):
-        logging.basicConfig(filename=simulate_keywords.Simulation.LOG_FILE,level=logging.INFO)
+    def __init__(self, trends_server, trends_version, cache=None, scheduler=None, timeline_workers=TIMELINE_WORKERS, timeline_store=None):
+        # Logging is set up once per process, this does nothing if it already is
+        log_setup.configure(simulate_keywords.Simulation.LOG_FILE)
         self.trends_version = trends_version
         self.trends_server = trends_server
-        self.service = self.build_service()
+        self.cache = cache
+        # Clients share one scheduler unless told otherwise so the whole process stays under quota
+        self.scheduler = scheduler or RequestScheduler.shared()
+        self.timeline_workers = timeline_workers
+        # Raw timelines are kept here (see timeline_store.py) so they can be re-aggregated without new calls
+        self.timeline_store = timeline_store
+        # Identical calls made at the same time (sibling branches, locations sharing this client) wait on one request
+        self.in_flight = SingleFlight()
+
+
+    """
+    Service object for the calling thread, built on first use.
+    httplib2 connections are not thread safe, so each thread gets its own service object.
+    """
+    @property
+    def service(self):
+        if not hasattr(_thread_services, "services"):
+            _thread_services.services = dict()
+        key = (self.trends_server, self.trends_version)
+        service = _thread_services.services.get(key)
+        if service is None:
+            service = self.build_service()
+            _thread_services.services[key] = service
+        return service
+
+
+    """
+    True when requests may only be answered from the cache
+    """
+    @property
+    def offline(self):
+        return self.cache is not None and self.cache.offline
+
+
+    def _discovery_path(self):
+        server = urlparse(self.trends_server).netloc.replace(":", "_")
+        return os.path.join(GoogleClient.DISCOVERY_DIR, "{}-trends-{}.json".format(server, self.trends_version))
+
+
+    """
+    Returns the discovery document of our trends api.
+    It is only fetched from TRENDS_SERVER if it is not on disk yet, so later runs start without a network round trip.
+    """
+    def discovery_document(self):
+        key = (self.trends_server, self.trends_version)
+        with _discovery_lock:
+            document = _discovery_documents.get(key)
+            if document is not None:
+                return document
+            path = self._discovery_path()
+            document = GoogleClient._read_discovery_document(path)
+            if document is None:
+                discovery_url = self.trends_server + '/discovery/v1/apis/trends/' + self.trends_version + '/rest'
+                trends_developer_key = os.environ.get('TRENDS_DEVELOPER_KEY')
+                if trends_developer_key:
+                    discovery_url += '?key=' + trends_developer_key
+                response, content = httplib2.Http().request(discovery_url)
+                if response.status >= 400:
+                    raise HttpError(response, content, uri=discovery_url)
+                document = content.decode("utf8")
+                simulate_keywords.Simulation.mkdir_p(GoogleClient.DISCOVERY_DIR)
+                # Written through a temporary file, so a run that dies mid-write never leaves half a document behind
+                temporary_path = "{}.{}.tmp".format(path, os.getpid())
+                with open(temporary_path, "w") as document_file:
+                    document_file.write(document)
+                os.replace(temporary_path, path)
+                logging.info("Saved the trends discovery document to {}".format(path))
+            _discovery_documents[key] = document
+            return document
+
+
+    """
+    The discovery document saved at PATH, or None when there is none or it does not parse
+    """
+    @staticmethod
+    def _read_discovery_document(path):
+        if not os.path.exists(path):
+            return None
+        with open(path, "r") as document_file:
+            document = document_file.read()
+        try:
+            json.loads(document)
+        except ValueError:
+            logging.warning("Discovery document {} is damaged, fetching it again".format(path))
+            return None
+        return document
 
 
     """
     Builds service to our trends api.
     """
     def build_service(self):
-        discovery_url = self.trends_server + '/discovery/v1/apis/trends/' + self.trends_version + '/rest'
         trends_developer_key = os.environ.get('TRENDS_DEVELOPER_KEY')
-        return build('trends', self.trends_version, developerKey=trends_developer_key, discoveryServiceUrl=discovery_url)
+        return build_from_document(self.discovery_document(), developerKey=trends_developer_key)
+
+
+    """
+    Every API call goes through here so responses can be served from and stored in the cache,
+    and so network requests are paced and retried by the scheduler.
+    Raises CacheMiss when the cache is offline and has never seen this request, and CallBudgetExhausted when the
+    request would go out to Google but the CallBudget the thread is charged to is spent.
+    Concurrent identical calls are coalesced, so they read the cache and spend quota once.
+    """
+    def _call(self, method, **params):
+        response, shared = self.in_flight.do(ResponseCache.make_key(method, params), lambda: self._fetch(method, params))
+        if shared:
+            metrics.REGISTRY.inc("trends_coalesced_total", method=method)
+        return response
+
+
+    def _fetch(self, method, params):
+        if self.cache is not None:
+            response = self.cache.get(method, params)
+            if response is not None:
+                metrics.REGISTRY.inc("trends_cache_total", method=method, result="hit")
+                return response
+            metrics.REGISTRY.inc("trends_cache_total", method=method, result="miss")
+            if self.cache.offline:
+                raise CacheMiss("{} {}".format(method, params))
+        budget = CallBudget.current()
+        if budget is not None:
+            # Only requests that go out to Google are charged, raises CallBudgetExhausted once it is spent
+            budget.spend()
+        response = self.scheduler.execute(lambda: getattr(self.service, method)(**params).execute(), endpoint=method)
+        if self.cache is not None:
+            self.cache.set(method, params, response)
+        return response
+
+
+    """
+    Error code of an HttpError, read from the error body when Google sends one
+    """
+    @staticmethod
+    def _error_code(e):
+        try:
+            return json.loads(e.content)["error"]["code"]
+        except (ValueError, KeyError, TypeError):
+            return e.resp.status
 
 
     """
@@ -49,89 +199,91 @@ class GoogleClient(object):
 
     """
      Take a TERM and a GEOLOCATION and a STARTDATE, ENDDATE, determines the top queries.
+     Returns None when the request failed for another reason than Google not having enough data.
     """
     def find_queries(self, word, geoLocation, startDate, endDate):
         returned_queries = []
         returned_values = []
 
         try:
-            response = self.service.getTopQueries(
+            response = self._call(
+                "getTopQueries",
                 term=word, restrictions_geo=geoLocation, restrictions_startDate=startDate, restrictions_endDate=endDate
-            ).execute()
+            )
             if response == {}:
                     return [],[]
             queries = response["item"]
-            logging.info(queries)
+            log_setup.log_event("trends.top_queries", term=word, geo=geoLocation, count=len(queries), payload=queries)
             # We get all queries, not just those with value >= 70
             # To collect most relevant (>=70) search queries, implement logic in for loop below
             for q in queries:
                 returned_queries.append(q["title"])
                 returned_values.append(q["value"])
 
+        except CacheMiss as e:
+            logging.warning("Offline and no cached top queries for {}".format(e))
+            return [],[]
         except HttpError as e:
-            error_content = json.loads(e.content)
-            code = error_content["error"]["code"]
+            code = GoogleClient._error_code(e)
             if code == 400:
                 # Not enough data to give us an accurate reading
                 logging.info("Not enough data returned by Google; cannot get top queries")
                 return [],[]
-            elif code == 429:
-                # Our trends rate has been exceeded, wait for two seconds and continue.
-                logging.info("Our rate has been exceeded, we will wait for two seconds and continue.")
-                time.sleep(2)
-                return self.find_queries(word, geoLocation, startDate, endDate)
-            elif (code // 100) == 5:
-                logging.error("An internal server error occured at the Google service, process and continue.")
-                logging.error(e.content)
-                time.sleep(3)
-                return self.find_queries(word, geoLocation, startDate, endDate)
+            elif code == 429 or (code // 100) == 5:
+                # The scheduler already retried this request as many times as it is allowed to
+                logging.error("Giving up on top queries for {} after repeated {} errors".format(word, code))
+                raise
             else:
-                pass
+                # Not an answer about the term (e.g. 403 over quota or a bad key), so nothing to record as done
+                logging.error("an unknown error appeared")
+                logging.error(e)
+                return None
         return returned_queries,returned_values
 
 
     """
     Take a TERM and a GEOLOCATION and a STARTDATE, ENDDATE, determines the top topics.
+    Returns None when the request failed for another reason than Google not having enough data.
     """
     def find_topics(self, term, geoLocation, startDate, endDate):
         if geoLocation == None:
             return term
         topics = set()
         try:
-            response = self.service.getTopTopics(
+            response = self._call(
+                "getTopTopics",
                 term=term, restrictions_geo=geoLocation, restrictions_startDate=startDate, restrictions_endDate=endDate
-            ).execute()
+            )
             items = response["item"]
             top_topic = items[0]["mid"]
             if top_topic not in topics:
                 topics.add(top_topic)
+        except CacheMiss as e:
+            logging.warning("Offline and no cached top topics for {}".format(e))
+            return []
         except HttpError as e:
-                error_content = json.loads(e.content)
-                code = error_content["error"]["code"]
+                code = GoogleClient._error_code(e)
                 if code == 404:
                     logging.info("Not enough info for this word")
                     return []
-                elif code == 429:
-                    logging.info("Our rate has been exceeded, wait and continue")
-                    time.sleep(2)
-                    pass
-                elif (code // 100) == 5:
-                    logging.error("Our google service has an internal server error, process and try again")
-                    time.sleep(1)
-                    pass
+                elif code == 429 or (code // 100) == 5:
+                    logging.error("Giving up on top topics for {} after repeated {} errors".format(term, code))
+                    raise
                 else:
                     logging.error("an unknown error appeared")
                     logging.error(e)
+                    return None
         return topics
 
 
     """
-    Returns call to getTimelinesForHealth with appropriate parameters based on geoLocation & loc_type
+    Calls getTimelinesForHealth with appropriate parameters based on geoLocation & loc_type
     """
     def _get_service_call_by_loc_type(self, loc_type, geoLocation, terms, startDate, endDate):
         if loc_type == "country":
             geo = geoLocation['code']
-            health_value = self.service.getTimelinesForHealth(
+            health_value = self._call(
+                "getTimelinesForHealth",
                 terms=terms,
                 time_startDate=startDate,
                 time_endDate=endDate,
@@ -140,7 +292,8 @@ class GoogleClient(object):
 
         elif loc_type == "region":
             geo = geoLocation['code']
-            health_value = self.service.getTimelinesForHealth(
+            health_value = self._call(
+                "getTimelinesForHealth",
                 terms=terms,
                 time_startDate=startDate,
                 time_endDate=endDate,
@@ -148,133 +301,322 @@ class GoogleClient(object):
             )
         else:
             geo = geoLocation['code'].split("-")[2]
-            health_value = self.service.getTimelinesForHealth(
+            health_value = self._call(
+                "getTimelinesForHealth",
                 terms=terms,
                 time_startDate=startDate,
                 time_endDate=endDate,
                 geoRestriction_dma=geo
             )
-        logging.info(health_value)
+        log_setup.log_event("trends.timelines", geo=geoLocation['code'], terms=len(terms), payload=health_value)
         return health_value
 
 
     """
-    Average points for each term in terms
-    """
-    def _average(self, values):
-        terms = values["lines"]
-        term_aggregate = []
-        total_agg = 0
-        for term in terms:
-            new_dict = dict()
-            points = term["points"]
-            index = 1
-            agg = 0
-            for point in points:
-                agg += point['value']
-                index += 1
-            average_points = float(agg)
-            total_agg += average_points
-            new_dict[term["term"]] = average_points
-            term_aggregate.append(copy.deepcopy(new_dict))
-        ret_values = []
-        logging.info(term_aggregate)
-        for dic in term_aggregate:
-            new_dict = {}
-            key = list(dic.keys())[0]
-            value = list(dic.values())[0]
-            average_value = value / float(total_agg)
-            new_dict[key] = average_value
-            ret_values.append(copy.deepcopy(new_dict))
-        return ret_values
+    Stack the timeline LINES returned by one request into a terms x time matrix.
+    Rows follow TERMS and columns follow DATES; terms Google returned nothing for stay at zero.
+    """
+    @staticmethod
+    def _timeline_matrix(lines, terms, dates):
+        term_index = {term: row for row, term in enumerate(terms)}
+        date_index = {date: column for column, date in enumerate(dates)}
+        matrix = np.zeros((len(terms), len(dates)))
+        for line in lines:
+            row = term_index.get(line["term"])
+            if row is None:
+                logging.warning("Google returned a timeline for {} which we did not ask for".format(line["term"]))
+                continue
+            columns = [date_index[point["date"]] for point in line["points"]]
+            matrix[row, columns] = [point["value"] for point in line["points"]]
+        return matrix
 
 
     """
-    Get normalized relative search volumes using getTimelinesForHealth google api call
+    Share of the total search volume for each term: sum each row over time, then divide by the grand total
     """
-    def get_timelines_for_health(self, terms, geoLocation, startDate, endDate):
+    def _average(self, terms, matrix):
+        totals = matrix.sum(axis=1)
+        total_agg = totals.sum()
+        if total_agg > 0:
+            totals = totals / total_agg
+        log_setup.log_event("trends.volumes", terms=len(terms), payload=dict(zip(terms, totals.tolist())))
+        return [{term: float(value)} for term, value in zip(terms, totals)]
+
+
+    """
+    Fetch the timelines of one batch of terms, returns None when Google does not have enough data.
+    Errors that are not an answer about the terms are raised.
+    """
+    def _get_timelines_batch(self, loc_type, geoLocation, request_terms, startDate, endDate):
+        try:
+            health_value = self._get_service_call_by_loc_type(loc_type, geoLocation, request_terms, startDate, endDate)
+            return health_value.get('lines', [])
+        except CacheMiss as e:
+            logging.warning("Offline and no cached timelines for {}".format(e))
+            return []
+        except HttpError as e:
+            code = GoogleClient._error_code(e)
+            if code == 404:
+                logging.info("Not enough info for this word")
+                return None
+            elif code == 429 or (code // 100) == 5:
+                logging.error("Giving up on timelines for {} after repeated {} errors".format(request_terms, code))
+                raise
+            else:
+                # A batch without data would put wrong volumes on the whole location, so the location fails instead
+                logging.error("Timelines for {} failed with {}".format(request_terms, code))
+                raise
+
+
+    """
+    Split TERMS into batches getTimelinesForHealth accepts: the first TIMELINE_BATCH_SIZE terms, then the rest with
+    ANCHOR, a term of the first batch, sent along in every batch. Google scales each request on its own, and the
+    anchor lets us bring all batches onto the scale of the first one.
+    """
+    def _timeline_batches(self, terms, anchor):
+        block = GoogleClient.TIMELINE_BATCH_SIZE
+        rest = terms[block:]
+        return [list(terms[:block])] + [[anchor] + rest[index:index + block - 1] for index in range(0, len(rest), block - 1)]
+
+
+    """
+    Volume of every one of REQUEST_TERMS in LINES (one batch's response), summed over time
+    """
+    @staticmethod
+    def _batch_volumes(lines, request_terms):
+        dates = list(dict.fromkeys(point["date"] for line in lines for point in line["points"]))
+        volumes = GoogleClient._timeline_matrix(lines, request_terms, dates).sum(axis=1)
+        return dict(zip(request_terms, volumes.tolist()))
+
+
+    """
+    Rescale BATCH_MATRIX in place so its anchor (row 0) has the volume REFERENCE it had in the first batch
+    """
+    @staticmethod
+    def rescale_on_anchor(batch_matrix, reference, anchor):
+        anchor_volume = batch_matrix[0].sum()
+        if anchor_volume > 0 and reference > 0:
+            batch_matrix *= reference / anchor_volume
+        else:
+            logging.warning("Anchor term {} has no volume, the batch cannot be rescaled".format(anchor))
+        return batch_matrix
+
+
+    """
+    Fetch every batch concurrently and merge them into one terms x time matrix on the scale of the
+    first batch. Returns (dates, matrix), or None when Google does not have enough data.
+    With more than one batch the first is fetched on its own, so the anchor can be its term with the most volume:
+    a term without data in this geo (e.g. a long tail query from another location) could not rescale anything.
+    A later batch in which the anchor has no volume after all is fetched again on the next loudest term.
+    """
+    def get_timelines_matrix(self, terms, geoLocation, startDate, endDate):
         loc_type = self._parse_geoLocation(geoLocation['code'])
-        points = dict()
-        # getTimelinesForHealth can only take 30 items at a time
-        # To get around this, we gather the frequencies for terms multiple times and compute the average frequency for the terms
-        if len(terms) <= 30:
-            health_value = self._get_service_call_by_loc_type(loc_type, geoLocation, terms, startDate, endDate)
-            try:
-                points = health_value.execute()
-                return self._average(points)
-            except HttpError as e:
-                error_content = json.loads(e.content)
-                code = error_content["error"]["code"]
-                if code == 404:
-                    logging.info("Not enough info for this word")
-                    return []
-                elif code == 429:
-                    logging.info("Our rate has been exceeded, wait and continue")
-                    time.sleep(2)
-                    pass
-                elif (code // 100) == 5:
-                    logging.error("Our google service has an internal server error, process and try again")
-                    time.sleep(1)
-                    pass
-                else:
-                    logging.error("an unknown error appeared")
-                    logging.error(e)
+        block = GoogleClient.TIMELINE_BATCH_SIZE
+
+        def fetch(request_terms):
+            return self._get_timelines_batch(loc_type, geoLocation, request_terms, startDate, endDate)
+
+        first_volumes = None
+        if len(terms) <= block:
+            batches = [list(terms)] if terms else []
+            results = [fetch(batch) for batch in batches]
         else:
-            bottom, top, block = 0, 1, 30
-            bottom_index = bottom * block
-            top_index = top * block
-            points = dict()
-            points['lines'] = []
-            while top_index < len(terms):
-                request_terms = terms[bottom_index:top_index]
-                health_value = self._get_service_call_by_loc_type(loc_type, geoLocation, request_terms, startDate, endDate)
-                try:
-                    points['lines'].extend(health_value.execute()['lines'])
-                except HttpError as e:
-                    error_content = json.loads(e.content)
-                    code = error_content["error"]["code"]
-                    if code == 404:
-                        logging.info("Not enough info for this word")
-                        return []
-                    elif code == 429:
-                        logging.info("Our rate has been exceeded, wait and continue")
-                        time.sleep(2)
-                        pass
-                    elif (code // 100) == 5:
-                        logging.error(error_content)
-                        logging.error("Our google service has an internal server error, process and try again")
-                        time.sleep(1)
-                        pass
-                    else:
-                        logging.error("an unknown error appeared")
-                        logging.error(e)
-
-                bottom_index += block
-                top_index += block
-
-            top_index = len(terms)
-            request_terms = terms[bottom_index:top_index]
+            first = fetch(terms[:block])
+            if first is None:
+                return None
+            first_volumes = GoogleClient._batch_volumes(first, terms[:block])
+            anchors = sorted(first_volumes, key=lambda term: -first_volumes[term])
+            batches = self._timeline_batches(terms, anchors[0])
+            with ThreadPoolExecutor(max_workers=self.timeline_workers) as executor:
+                results = [first] + list(executor.map(fetch, batches[1:]))
+        if any(lines is None for lines in results):
+            return None
 
-            health_value = self._get_service_call_by_loc_type(loc_type, geoLocation, request_terms, startDate, endDate)
+        # Google sends points in date order; keep that order rather than sorting the formatted date strings
+        dates = list(dict.fromkeys(point["date"] for lines in results for line in lines for point in line["points"]))
+        matrix = np.zeros((len(terms), len(dates)))
+        term_index = {term: row for row, term in enumerate(terms)}
+        for index, (request_terms, lines) in enumerate(zip(batches, results)):
+            batch_matrix = GoogleClient._timeline_matrix(lines, request_terms, dates)
+            if index > 0:
+                for anchor in anchors[1:3]:
+                    if batch_matrix[0].sum() > 0 or first_volumes[anchor] <= 0:
+                        break
+                    logging.info("Anchor term {} has no volume in a batch, fetching it again on {}".format(request_terms[0], anchor))
+                    retry_terms = [anchor] + request_terms[1:]
+                    retry_lines = fetch(retry_terms)
+                    if retry_lines:
+                        request_terms, batch_matrix = retry_terms, GoogleClient._timeline_matrix(retry_lines, retry_terms, dates)
+                # Rescale so the anchor (row 0) has the same volume as in the first batch, where its row comes from
+                GoogleClient.rescale_on_anchor(batch_matrix, first_volumes[request_terms[0]], request_terms[0])
+                request_terms, batch_matrix = request_terms[1:], batch_matrix[1:]
+            rows = [term_index[term] for term in request_terms]
+            matrix[rows] = batch_matrix
+        self._store_timelines(geoLocation, startDate, endDate, terms, dates, matrix)
+        return dates, matrix
 
-            try:
-                points['lines'].extend(health_value.execute()['lines'])
-            except HttpError as e:
-                error_content = json.loads(e.content)
-                code = error_content["error"]["code"]
-                if code == 404:
-                    logging.info("Not enough info for this word")
-                    return []
-                elif code == 429:
-                    logging.info("Our rate has been exceeded, wait and continue")
-                    time.sleep(2)
-                    pass
-                elif (code // 100) == 5:
-                    logging.error(error_content)
-                    logging.error("Our google service has an internal server error, process and try again")
-                    time.sleep(1)
-                    pass
-                else:
-                    logging.error("an unknown error appeared")
-                    logging.error(e)
-            return self._average(points)
+
+    """
+    Parse a timeline point date, Google sends them like "Jan 05 2020"
+    """
+    @staticmethod
+    def timeline_date(value):
+        return parse_timeline_date(value)
+
+
+    """
+    Join two (dates, matrix) timelines of the same terms where TAIL continues HEAD.
+    Both windows are scaled by Google independently, so TAIL is rescaled to match HEAD on the dates they share.
+    """
+    @staticmethod
+    def stitch_timelines(head, tail):
+        head_dates, head_matrix = head
+        tail_dates, tail_matrix = tail
+        head_index = {date: column for column, date in enumerate(head_dates)}
+        shared = [(head_index[date], column) for column, date in enumerate(tail_dates) if date in head_index]
+        scale = 1.0
+        if shared:
+            head_volume = head_matrix[:, [column for column, _ in shared]].sum()
+            tail_volume = tail_matrix[:, [column for _, column in shared]].sum()
+            if tail_volume > 0:
+                scale = head_volume / tail_volume
+        else:
+            logging.warning("Timeline windows do not overlap, they are joined without rescaling")
+        new_columns = [column for column, date in enumerate(tail_dates) if date not in head_index]
+        dates = list(head_dates) + [tail_dates[column] for column in new_columns]
+        return dates, np.hstack([head_matrix, tail_matrix[:, new_columns] * scale])
+
+
+    """
+    Split STARTDATE..ENDDATE (YYYY-MM-DD) into windows of TIMELINE_SHARD_DAYS counted from STARTDATE, as
+    (startDate, endDate) pairs. Every window but the first starts TIMELINE_OVERLAP_DAYS early to overlap the one before.
+    A remainder shorter than the overlap is added to the window before it rather than asked for as a window that
+    is almost all overlap, so a leap year is still one request.
+    Windows are laid out from the start, so extending ENDDATE leaves all but the last two windows unchanged.
+    """
+    @staticmethod
+    def _date_shards(startDate, endDate, shard_days=TIMELINE_SHARD_DAYS, overlap_days=TIMELINE_OVERLAP_DAYS):
+        if startDate > endDate:
+            raise ValueError("Timeline range {}..{} ends before it starts".format(startDate, endDate))
+        if len(startDate) != 10 or len(endDate) != 10:
+            return [(startDate, endDate)]
+        start, end = datetime.date.fromisoformat(startDate), datetime.date.fromisoformat(endDate)
+        shards = []
+        shard_start = start
+        while shard_start <= end:
+            shard_end = shard_start + datetime.timedelta(days=shard_days - 1)
+            if (end - shard_end).days < overlap_days:
+                shard_end = end
+            request_start = max(start, shard_start - datetime.timedelta(days=overlap_days))
+            shards.append((request_start.isoformat(), shard_end.isoformat()))
+            shard_start = shard_end + datetime.timedelta(days=1)
+        return shards
+
+
+    """
+    Keep raw timelines in the timeline store. The store is a side copy, so failing to write it never fails a fetch.
+    """
+    def _store_timelines(self, geoLocation, startDate, endDate, terms, dates, matrix):
+        if self.timeline_store is None or self.offline:
+            return
+        try:
+            self.timeline_store.put(geoLocation['code'], startDate, endDate, terms, dates, matrix)
+        except Exception:
+            logging.exception("Could not store timelines for {} {}..{}".format(geoLocation['code'], startDate, endDate))
+
+
+    """
+    (dates, matrix) of TERMS for GEO and the window from the timeline store, None unless every term is stored
+    """
+    def _stored_timelines(self, terms, geoLocation, startDate, endDate):
+        if self.timeline_store is None:
+            return None
+        try:
+            view = self.timeline_store.get(geoLocation['code'], startDate, endDate, terms)
+            if view is None:
+                return None
+            return list(view.dates), np.asarray(view.rows(terms), dtype=np.float64)
+        except Exception:
+            logging.exception("Could not read stored timelines for {} {}..{}".format(geoLocation['code'], startDate, endDate))
+            return None
+
+
+    """
+    Like get_timelines_matrix, but ranges longer than TIMELINE_SHARD_DAYS are requested as overlapping windows,
+    fetched concurrently and stitched together on the scale of the first window (see stitch_timelines).
+    Windows and the stitched range are kept in the timeline store, so a window that has closed and was fetched
+    before is read from there and extending the range only fetches the new tail. Windows still open are always
+    fetched, Google keeps adding to them.
+    """
+    def get_timelines_sharded(self, terms, geoLocation, startDate, endDate):
+        shards = GoogleClient._date_shards(startDate, endDate)
+        if len(shards) == 1:
+            return self.get_timelines_matrix(terms, geoLocation, startDate, endDate)
+        stored = self._stored_timelines(terms, geoLocation, startDate, endDate) if is_closed_window(endDate) else None
+        if stored is not None:
+            return stored
+
+        def fetch(shard):
+            stored = self._stored_timelines(terms, geoLocation, *shard) if is_closed_window(shard[1]) else None
+            return stored or self.get_timelines_matrix(terms, geoLocation, *shard)
+
+        with ThreadPoolExecutor(max_workers=self.timeline_workers) as executor:
+            windows = list(executor.map(fetch, shards))
+        if any(window is None for window in windows):
+            return None
+        timelines = windows[0]
+        for window in windows[1:]:
+            timelines = GoogleClient.stitch_timelines(timelines, window)
+        self._store_timelines(geoLocation, startDate, endDate, terms, *timelines)
+        return timelines
+
+
+    """
+    Timelines of one batch of TERMS (at most TIMELINE_BATCH_SIZE) as (dates, matrix), for callers that batch
+    terms themselves, like the streaming pipeline. TERMS[0] is the anchor: with REFERENCE, its volume in the
+    first batch, the batch is rescaled onto that batch's scale. Long ranges are sharded like get_timelines_sharded.
+    Returns None when Google does not have enough data.
+    """
+    def get_anchored_batch(self, terms, geoLocation, startDate, endDate, reference=None):
+        if len(terms) > GoogleClient.TIMELINE_BATCH_SIZE:
+            raise ValueError("A batch takes at most {} terms, got {}".format(GoogleClient.TIMELINE_BATCH_SIZE, len(terms)))
+        timelines = self.get_timelines_sharded(terms, geoLocation, startDate, endDate)
+        if timelines is None or reference is None:
+            return timelines
+        dates, matrix = timelines
+        return dates, GoogleClient.rescale_on_anchor(np.array(matrix, dtype=np.float64), reference, terms[0])
+
+
+    """
+    Timelines of the same TERMS for every geo in GEOLOCATIONS as a TimelineTensor (terms x geos x dates).
+    Geos are requested concurrently, each in anchored batches and date windows like get_timelines_sharded.
+    """
+    def get_timelines_tensor(self, terms, geoLocations, startDate, endDate):
+        with ThreadPoolExecutor(max_workers=self.timeline_workers) as executor:
+            results = list(executor.map(
+                lambda geoLocation: self.get_timelines_sharded(terms, geoLocation, startDate, endDate), geoLocations
+            ))
+        dates = list(dict.fromkeys(date for result in results if result is not None for date in result[0]))
+        date_index = {date: column for column, date in enumerate(dates)}
+        values = np.full((len(terms), len(geoLocations), len(dates)), np.nan)
+        for geo, result in enumerate(results):
+            if result is None:
+                logging.warning("No timelines for {}".format(geoLocations[geo]['code']))
+                continue
+            geo_dates, matrix = result
+            values[:, geo, [date_index[date] for date in geo_dates]] = matrix
+        return TimelineTensor(terms, [geoLocation['code'] for geoLocation in geoLocations], dates, values)
+
+
+    """
+    Get normalized relative search volumes using getTimelinesForHealth google api call
+    """
+    def get_timelines_for_health(self, terms, geoLocation, startDate, endDate):
+        # getTimelinesForHealth can only take 30 items at a time
+        # To get around this, we request the terms in anchored batches and put them on one scale before normalizing
+        # Long ranges are requested in windows and stitched, see get_timelines_sharded
+        timelines = self.get_timelines_sharded(terms, geoLocation, startDate, endDate)
+        if timelines is None:
+            return []
+        dates, matrix = timelines
+        return self._average(terms, matrix)
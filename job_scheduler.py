@@ -0,0 +1,262 @@
+import os
+import sys
+import json
+import math
+import logging
+import argparse
+import datetime
+import simulate_keywords
+import run_simulation
+from google_client import GoogleClient
+from rate_limiter import RequestScheduler
+from response_cache import SQLiteResponseCache
+from output_store import OutputStore
+from journal import Journal
+from query_index import QueryIndex
+from search import QuotaTracker
+import log_setup
+
+
+class BudgetExhausted(Exception):
+    pass
+
+
+"""
+Trends API calls we allow ourselves per day, kept on disk at PATH so every run on the same day shares it
+(see search.QuotaTracker)
+"""
+class DailyBudget(QuotaTracker):
+
+    """
+    Take one call from today's budget, raises BudgetExhausted once it is used up
+    """
+    def spend(self):
+        if not self.acquire():
+            raise BudgetExhausted("Daily budget of {} calls is used up".format(self.daily_limit))
+
+
+"""
+RequestScheduler that takes every attempt from a DailyBudget, so a run stops at the budget instead of running
+into Google's quota. Retries count too, they cost quota like any other call.
+"""
+class BudgetedScheduler(RequestScheduler):
+
+    def __init__(self, budget, **kwargs):
+        super(BudgetedScheduler, self).__init__(**kwargs)
+        self.budget = budget
+
+
+    def execute(self, request, endpoint="unknown"):
+        def spend_and_request():
+            self.budget.spend()
+            return request()
+        return super(BudgetedScheduler, self).execute(spend_and_request, endpoint)
+
+
+"""
+Persistent queue of simulation jobs, one per seed term, location and date window.
+Jobs run in priority order until the day's budget is spent. The budget is enforced call by call (see BudgetedScheduler),
+so a job that is cut off stays pending and its journaled calls are not paid for again when it resumes the next day.
+Costs are estimated from the finished jobs, or from the expansion depth and BRANCHING (new queries per
+getTopQueries call) before any job has finished, to plan the day and project when the queue will be done.
+The queue is saved after every job.
+"""
+class JobScheduler(object):
+    QUEUE_FILE = "journal/jobs.json"
+    BRANCHING = 8
+    MAX_ATTEMPTS = 3 # Attempts that fail for other reasons than the budget before a job is given up on
+
+    def __init__(self, path=QUEUE_FILE, max_depth=simulate_keywords.Simulation.MAX_DEPTH, branching=BRANCHING):
+        self.path = path
+        self.max_depth = max_depth
+        self.branching = branching
+        self.jobs = []
+        if os.path.exists(path):
+            with open(path, "r") as queue_file:
+                self.jobs = json.load(queue_file)["jobs"]
+
+
+    def save(self):
+        simulate_keywords.Simulation.mkdir_p(os.path.dirname(self.path) or ".")
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w") as queue_file:
+            json.dump({"jobs": self.jobs}, queue_file, indent=1)
+        os.replace(temporary_path, self.path)
+
+
+    @staticmethod
+    def job_id(seed, geo, window):
+        return json.dumps([seed, geo] + list(window))
+
+
+    """
+    Queue every combination of SEEDS, LOCATIONS and WINDOWS (startTrends, endTrends, startTimelines, endTimelines)
+    that is not queued yet. Returns the number of jobs added.
+    """
+    def add(self, seeds, locations, windows, priority=0):
+        known = set(job["id"] for job in self.jobs)
+        added = 0
+        for seed in seeds:
+            for loc in locations:
+                for window in windows:
+                    job_id = JobScheduler.job_id(seed, loc["code"], window)
+                    if job_id in known:
+                        continue
+                    known.add(job_id)
+                    self.jobs.append({
+                        "id": job_id, "seed": seed, "location": loc, "window": list(window),
+                        "priority": priority, "status": "pending", "attempts": 0, "spent": 0,
+                    })
+                    added += 1
+        self.save()
+        return added
+
+
+    """
+    Calls one job is expected to make: topics, the seed's top queries, one getTopQueries call for every query
+    above the last level and the anchored timeline batches for level 1
+    """
+    def estimate(self):
+        costs = [job["spent"] for job in self.jobs if job["status"] == "done"]
+        if costs:
+            return sum(costs) / float(len(costs))
+        expansion = sum(self.branching ** level for level in range(1, self.max_depth))
+        batches = math.ceil(self.branching / float(GoogleClient.TIMELINE_BATCH_SIZE - 1))
+        return 2 + expansion + batches
+
+
+    """
+    Calls JOB still needs, what it has spent in earlier attempts is already in the journal
+    """
+    def remaining_cost(self, job, estimate=None):
+        estimate = self.estimate() if estimate is None else estimate
+        return max(1.0, estimate - job["spent"])
+
+
+    def pending(self):
+        jobs = [job for job in self.jobs if job["status"] == "pending"]
+        # Highest priority first, queue order within a priority
+        return sorted(jobs, key=lambda job: -job["priority"])
+
+
+    """
+    Jobs expected to finish within BUDGET calls, in the order they will run
+    """
+    def plan(self, budget):
+        planned = []
+        estimate = self.estimate()
+        for job in self.pending():
+            cost = self.remaining_cost(job, estimate)
+            if cost > budget:
+                break
+            planned.append(job)
+            budget -= cost
+        return planned
+
+
+    """
+    Run pending jobs with GOOGLE_CLIENT, whose scheduler must be a BudgetedScheduler over BUDGET, until the
+    budget is spent or the queue is empty. Returns the number of jobs finished.
+    """
+    def run(self, google_client, budget, output_store=None, journal=None, query_index=None):
+        finished = 0
+        for job in self.pending():
+            if budget.remaining == 0:
+                break
+            startTrends, endTrends, startTimelines, endTimelines = job["window"]
+            before = budget.spent
+            try:
+                run_simulation.run_location(
+                    job["seed"], job["location"], google_client, startTrends, endTrends, startTimelines, endTimelines,
+                    max_depth=self.max_depth, output_store=output_store, journal=journal, query_index=query_index
+                )
+            except BudgetExhausted:
+                job["spent"] += budget.spent - before
+                logging.info("Budget used up during {}, it continues next time".format(job["id"]))
+                self.save()
+                break
+            except Exception:
+                logging.exception("Job {} failed".format(job["id"]))
+                job["attempts"] += 1
+                if job["attempts"] >= JobScheduler.MAX_ATTEMPTS:
+                    job["status"] = "failed"
+            else:
+                job["status"] = "done"
+                finished += 1
+            job["spent"] += budget.spent - before
+            self.save()
+        return finished
+
+
+    """
+    Jobs per status, calls still needed and the day the queue is expected to be done at DAILY_LIMIT calls a day
+    """
+    def report(self, daily_limit, remaining_today=None):
+        counts = dict()
+        for job in self.jobs:
+            counts[job["status"]] = counts.get(job["status"], 0) + 1
+        estimate = self.estimate()
+        calls_needed = sum(self.remaining_cost(job, estimate) for job in self.pending())
+        remaining_today = daily_limit if remaining_today is None else remaining_today
+        days = 0 if calls_needed <= remaining_today else int(math.ceil((calls_needed - remaining_today) / float(daily_limit)))
+        return {
+            "jobs": counts,
+            "estimated_calls_per_job": estimate,
+            "estimated_calls_remaining": calls_needed,
+            "jobs_today": len(self.plan(remaining_today)),
+            "projected_completion": (datetime.date.today() + datetime.timedelta(days=days)).isoformat(),
+        }
+
+
+def parse_window(value):
+    window = value.split(",")
+    if len(window) != 4:
+        raise argparse.ArgumentTypeError("a window is startTrends,endTrends,startTimelines,endTimelines")
+    return window
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Run seed x location x window simulations within a daily call budget")
+    parser.add_argument("--queue", default=JobScheduler.QUEUE_FILE, help="where the job queue is kept")
+    parser.add_argument("--budget", type=int, default=10000, help="Trends API calls allowed per day")
+    parser.add_argument("--budget-file", default="journal/budget.json")
+    parser.add_argument("--max-depth", type=int, default=simulate_keywords.Simulation.MAX_DEPTH)
+    commands = parser.add_subparsers(dest="command")
+    add = commands.add_parser("add", help="queue every seed, location and window combination")
+    add.add_argument("initial_search_terms", nargs="+")
+    add.add_argument("--locations", default=simulate_keywords.Simulation.LOCATIONS_FILE)
+    add.add_argument("--window", type=parse_window, action="append", help="startTrends,endTrends,startTimelines,endTimelines")
+    add.add_argument("--priority", type=int, default=0, help="higher runs first")
+    run = commands.add_parser("run", help="run as many queued jobs as today's budget allows")
+    run.add_argument("--cache", default=simulate_keywords.Simulation.CACHE_FILE)
+    run.add_argument("--journal", default=simulate_keywords.Simulation.JOURNAL_FILE)
+    commands.add_parser("report", help="print queue status and projected completion")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    log_setup.configure(simulate_keywords.Simulation.LOG_FILE)
+    scheduler = JobScheduler(args.queue, max_depth=args.max_depth)
+    budget = DailyBudget(args.budget, args.budget_file)
+    if args.command == "add":
+        windows = args.window or [("2020-01", "2020-08", "2020-01-01", "2020-08-31")]
+        added = scheduler.add(args.initial_search_terms, run_simulation.load_geolocations(args.locations), windows, args.priority)
+        print("Queued {} jobs".format(added))
+    elif args.command == "run":
+        cache = SQLiteResponseCache(args.cache)
+        journal = Journal(args.journal)
+        google_client = GoogleClient(
+            simulate_keywords.Simulation.TRENDS_SERVER, simulate_keywords.Simulation.TRENDS_VERSION,
+            cache=cache, scheduler=BudgetedScheduler(budget)
+        )
+        with OutputStore() as output_store:
+            finished = scheduler.run(google_client, budget, output_store=output_store, journal=journal, query_index=QueryIndex())
+        journal.close()
+        print("Finished {} jobs, {} calls left today".format(finished, budget.remaining))
+    print(json.dumps(scheduler.report(args.budget, budget.remaining), indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
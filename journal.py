@@ -0,0 +1,121 @@
+import os
+import json
+import time
+import logging
+import datetime
+import threading
+from response_cache import is_closed_window
+
+
+"""
+Append-only journal of completed units of work, one JSON line per (method, term, geo, window) and its result.
+A simulation that is restarted with the same journal reads finished units back instead of calling the API again,
+so it carries on from the frontier where the previous run stopped. Safe to share between threads and locations.
+Like the response cache, units for a window that had not ended yet when they were recorded are only used
+for TTL seconds (None trusts them forever), since Google still adds to that data.
+"""
+class Journal(object):
+
+    def __init__(self, path, ttl=24 * 60 * 60):
+        self.path = path
+        self.ttl = ttl
+        self._results = dict()
+        # (method, term, geo, startDate) -> {endDate: result}, to find earlier windows of the same unit
+        self._windows = dict()
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        if os.path.exists(path):
+            self._load()
+        self._file = open(path, "a")
+
+
+    @staticmethod
+    def _key(method, term, geo, startDate, endDate):
+        return json.dumps([method, term, geo, startDate, endDate])
+
+
+    def _load(self):
+        with open(self.path, "r") as journal_file:
+            for number, line in enumerate(journal_file, 1):
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # The run was killed while writing this line, the unit will simply be done again
+                    logging.warning("Skipping unreadable line {} of journal {}".format(number, self.path))
+                    continue
+                self._store(
+                    entry["method"], entry["term"], entry["geo"], entry["startDate"], entry["endDate"], entry["result"],
+                    entry.get("recorded")
+                )
+        logging.info("Loaded {} completed units from journal {}".format(len(self._results), self.path))
+
+
+    def _store(self, method, term, geo, startDate, endDate, result, recorded):
+        self._results[Journal._key(method, term, geo, startDate, endDate)] = (result, recorded)
+        window = Journal._key(method, term, geo, startDate, None)
+        self._windows.setdefault(window, dict())[endDate] = (result, recorded)
+
+
+    """
+    Whether a unit for a window ending at ENDDATE, recorded at RECORDED (seconds since the epoch), can be used
+    """
+    def _fresh(self, endDate, recorded):
+        if recorded is None:
+            # Journaled before units carried their time: only trust windows that have ended by now
+            return is_closed_window(endDate)
+        if self.ttl is None or is_closed_window(endDate, datetime.date.fromtimestamp(recorded)):
+            return True
+        return time.time() - recorded < self.ttl
+
+
+    """
+    Result of a completed unit, or None if it has not been done yet or has expired
+    """
+    def get(self, method, term, geo, startDate, endDate):
+        with self._lock:
+            entry = self._results.get(Journal._key(method, term, geo, startDate, endDate))
+        if entry is None or not self._fresh(endDate, entry[1]):
+            return None
+        return entry[0]
+
+
+    """
+    Record that a unit finished with RESULT, which must be JSON serializable
+    """
+    def record(self, method, term, geo, startDate, endDate, result):
+        recorded = time.time()
+        line = json.dumps({
+            "method": method, "term": term, "geo": geo, "startDate": startDate, "endDate": endDate, "result": result,
+            "recorded": recorded,
+        })
+        with self._lock:
+            self._store(method, term, geo, startDate, endDate, result, recorded)
+            self._file.write(line + "\n")
+            self._file.flush()
+
+
+    """
+    The completed unit for METHOD, TERM and GEO starting at STARTDATE with the latest end date before ENDDATE,
+    as (end date, result). Used to extend a window instead of fetching it again. None if there is none.
+    """
+    def find_earlier_window(self, method, term, geo, startDate, endDate):
+        with self._lock:
+            windows = self._windows.get(Journal._key(method, term, geo, startDate, None), dict())
+            earlier = [end for end, (_, recorded) in windows.items() if end < endDate and self._fresh(end, recorded)]
+            if not earlier:
+                return None
+            return max(earlier), windows[max(earlier)][0]
+
+
+    def __len__(self):
+        with self._lock:
+            return len(self._results)
+
+
+    def close(self):
+        with self._lock:
+            self._file.close()
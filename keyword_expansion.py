@@ -0,0 +1,146 @@
+import heapq
+import itertools
+import collections
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import metrics
+from rate_limiter import CallBudgetExhausted
+import log_setup
+
+
+"""
+Expands top queries into a tree of follow up queries using a work-queue frontier.
+Up to MAX_WORKERS getTopQueries calls are in flight at once. expand merges results in the order
+the nodes were queued (breadth first) so deduplication stays deterministic between runs;
+expand_best_first follows the most relevant queries first within an expansion and a call budget.
+"""
+class KeywordExpander(object):
+
+    def __init__(self, find_queries, max_depth=3, max_workers=8, canonical=None):
+        # FIND_QUERIES takes a query and returns its (follow up queries, values)
+        self.find_queries = find_queries
+        # CANONICAL maps a query to the form used for deduplication, exact strings when None
+        self.canonical = canonical or (lambda query: query)
+        self.max_depth = max_depth
+        self.max_workers = max_workers
+
+
+    def _fetch(self, graph, node):
+        return self.find_queries(graph.query(node))
+
+
+    """
+    Expand the nodes NODES of GRAPH (a KeywordGraph) until MAX_DEPTH levels exist.
+    New queries are added to GRAPH as children of the node that returned them.
+    SEEN is the set of (canonical) queries already in the graph and is updated in place, a query is only
+    ever added once no matter how many parents return it.
+    """
+    def expand(self, graph, nodes, seen):
+        if len(nodes) == 0:
+            return
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            pending = collections.deque()
+            for node in nodes:
+                if graph.level(node) < self.max_depth:
+                    pending.append((node, executor.submit(self._fetch, graph, node)))
+
+            while pending:
+                metrics.REGISTRY.set_gauge("expansion_queue_depth", len(pending))
+                node, future = pending.popleft()
+                follow_up_queries, follow_up_values = future.result()
+                level = graph.level(node) + 1
+                for query, value in zip(follow_up_queries, follow_up_values):
+                    key = self.canonical(query)
+                    if key in seen:
+                        continue
+                    log_setup.log_event("expansion.added", query=query, depth=level, parent=graph.query(node))
+                    child = graph.add(query, value, level, parent=node)
+                    seen.add(key)
+                    metrics.REGISTRY.inc("expansion_items_total", level=level)
+                    if level < self.max_depth:
+                        pending.append((child, executor.submit(self._fetch, graph, child)))
+            metrics.REGISTRY.set_gauge("expansion_queue_depth", 0)
+
+
+    """
+    Expand NODES of GRAPH most relevant first instead of breadth first.
+    A node's score is its value (0-100) as a fraction, times the score of its parent, so a query only ranks high when
+    the whole path to it is relevant. Nodes with a value below MIN_VALUE are kept in the graph but not expanded,
+    and no more than EXPANSION_BUDGET queries are expanded, however they are answered. CALL_BUDGET (a CallBudget,
+    usually shared by every location of the seed) is charged for each expansion that goes out to Google, and
+    expansion stops once it is spent. Returns a report of the queries expanded and of the coverage given up:
+    the expandable nodes that were pruned or left over, and their share of the total score of all expandable nodes.
+    """
+    def expand_best_first(self, graph, nodes, seen, min_value=0, expansion_budget=None, call_budget=None):
+        report = {"expansions": 0, "pruned": 0, "unexpanded": 0, "score_expanded": 0.0, "score_given_up": 0.0}
+        scores = dict()
+        frontier = []
+        counter = itertools.count()
+
+        def offer(node, score):
+            scores[node] = score
+            if graph.level(node) >= self.max_depth:
+                return
+            if graph.value(node) < min_value:
+                report["pruned"] += 1
+                report["score_given_up"] += score
+                return
+            heapq.heappush(frontier, (-score, next(counter), node))
+
+        def fetch(node):
+            if call_budget is None:
+                return self._fetch(graph, node)
+            with call_budget.charging():
+                return self._fetch(graph, node)
+
+        def within_budget():
+            if expansion_budget is not None and report["expansions"] >= expansion_budget:
+                return False
+            return call_budget is None or not call_budget.exhausted
+
+        for node in nodes:
+            offer(node, graph.value(node) / 100.0)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            in_flight = dict()
+            while frontier or in_flight:
+                while frontier and len(in_flight) < self.max_workers and within_budget():
+                    negative_score, _, node = heapq.heappop(frontier)
+                    in_flight[executor.submit(fetch, node)] = node
+                    report["expansions"] += 1
+                    report["score_expanded"] += -negative_score
+                metrics.REGISTRY.set_gauge("expansion_queue_depth", len(frontier))
+                if not in_flight:
+                    break
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    node = in_flight.pop(future)
+                    try:
+                        follow_up_queries, follow_up_values = future.result()
+                    except CallBudgetExhausted:
+                        # The budget ran out while this call was in flight, the node stays unexpanded
+                        report["expansions"] -= 1
+                        report["score_expanded"] -= scores[node]
+                        heapq.heappush(frontier, (-scores[node], next(counter), node))
+                        continue
+                    level = graph.level(node) + 1
+                    for query, value in zip(follow_up_queries, follow_up_values):
+                        key = self.canonical(query)
+                        if key in seen:
+                            continue
+                        log_setup.log_event("expansion.added", query=query, depth=level, parent=graph.query(node))
+                        child = graph.add(query, value, level, parent=node)
+                        seen.add(key)
+                        metrics.REGISTRY.inc("expansion_items_total", level=level)
+                        offer(child, scores[node] * value / 100.0)
+
+        # Whatever is left in the frontier was cut off by a budget
+        report["unexpanded"] = len(frontier)
+        report["score_given_up"] += sum(-negative_score for negative_score, _, _ in frontier)
+        total = report["score_expanded"] + report["score_given_up"]
+        report["coverage"] = report["score_expanded"] / total if total > 0 else 1.0
+        if call_budget is not None:
+            report["calls_spent"] = call_budget.calls
+        metrics.REGISTRY.set_gauge("expansion_queue_depth", 0)
+        metrics.REGISTRY.inc("expansion_pruned_total", report["pruned"])
+        metrics.REGISTRY.inc("expansion_unexpanded_total", report["unexpanded"])
+        return report
@@ -0,0 +1,160 @@
+import sys
+import array
+import threading
+import numpy as np
+
+
+"""
+Compact graph of expanded queries.
+Nodes are integer ids into parallel arrays of query string id, parent node, level and value; query strings are
+interned once per graph (and with sys.intern across graphs). Roots are the top queries of the seed term and have
+parent -1. Nodes are added in the order expansion finds them, so walking the ids in order is breadth first
+(for best first expansion, parents still come before their children).
+"""
+class KeywordGraph(object):
+
+    def __init__(self):
+        self.strings = []
+        self._string_ids = dict()
+        self._queries = array.array("i")
+        self._parents = array.array("i")
+        self._levels = array.array("b")
+        self._values = array.array("i") # Google's top query scores are integers, 0 to 100
+        self._lock = threading.Lock()
+
+
+    def __len__(self):
+        return len(self._queries)
+
+
+    def _intern(self, query):
+        string_id = self._string_ids.get(query)
+        if string_id is None:
+            string_id = self._string_ids[query] = len(self.strings)
+            self.strings.append(sys.intern(query))
+        return string_id
+
+
+    """
+    Add QUERY under PARENT (a node id, -1 for a top query) and return its node id
+    """
+    def add(self, query, value, level, parent=-1):
+        with self._lock:
+            node = len(self._queries)
+            self._queries.append(self._intern(query))
+            self._parents.append(parent)
+            self._levels.append(level)
+            self._values.append(int(value))
+            return node
+
+
+    def query(self, node):
+        return self.strings[self._queries[node]]
+
+
+    def value(self, node):
+        return self._values[node]
+
+
+    def level(self, node):
+        return self._levels[node]
+
+
+    def parent(self, node):
+        return self._parents[node]
+
+
+    def _array(self, column, dtype):
+        with self._lock:
+            return np.array(column, dtype=dtype)
+
+
+    """
+    Node ids at LEVEL, or at every level up to MAX_LEVEL, in the order they were added
+    """
+    def nodes(self, level=None, max_level=None):
+        levels = self._array(self._levels, np.int8)
+        mask = np.ones(len(levels), dtype=bool)
+        if level is not None:
+            mask &= levels == level
+        if max_level is not None:
+            mask &= levels <= max_level
+        return np.flatnonzero(mask)
+
+
+    """
+    Query strings of the nodes at LEVEL (every node when None)
+    """
+    def queries(self, level=None):
+        return [self.query(node) for node in self.nodes(level)]
+
+
+    def levels(self):
+        return self._array(self._levels, np.int8)
+
+
+    def values(self):
+        return self._array(self._values, np.int32)
+
+
+    def parents(self):
+        return self._array(self._parents, np.int32)
+
+
+    def children(self, node):
+        return np.flatnonzero(self.parents() == node)
+
+
+    """
+    Edge list as two arrays of node ids, (parents, children), one entry per node that has a parent
+    """
+    def edge_list(self):
+        parents = self.parents()
+        children = np.flatnonzero(parents >= 0)
+        return parents[children], children
+
+
+    """
+    Every node as (query, value, level, parent query), breadth first; parent query is None for top queries
+    """
+    def rows(self):
+        for node in range(len(self)):
+            parent = self._parents[node]
+            yield self.query(node), self.value(node), self._levels[node], self.query(parent) if parent >= 0 else None
+
+
+    """
+    Add every node of OTHER (e.g. the graph of another location) to this graph, keeping its structure.
+    Returns the node id OTHER's node 0 got here; other node ids are shifted by the same amount.
+    """
+    def merge(self, other):
+        with other._lock:
+            queries = [other.strings[string_id] for string_id in other._queries]
+            parents = array.array("i", other._parents)
+            levels = array.array("b", other._levels)
+            values = array.array("i", other._values)
+        with self._lock:
+            offset = len(self._queries)
+            self._queries.extend(self._intern(query) for query in queries)
+            self._parents.extend(parent + offset if parent >= 0 else -1 for parent in parents)
+            self._levels.extend(levels)
+            self._values.extend(values)
+        return offset
+
+
+    """
+    The graph as nested dicts ({"query", "value", "level", "follow_up_terms"}), one per top query,
+    the shape Simulation.initial_queries used to have
+    """
+    def as_tree(self):
+        items = []
+        roots = []
+        for node in range(len(self)):
+            item = {"query": self.query(node), "value": self.value(node), "level": self._levels[node], "follow_up_terms": []}
+            items.append(item)
+            parent = self._parents[node]
+            if parent >= 0:
+                items[parent]["follow_up_terms"].append(item)
+            else:
+                roots.append(item)
+        return roots
@@ -0,0 +1,145 @@
+import os
+import copy
+import json
+import queue
+import atexit
+import random
+import logging
+import threading
+import logging.handlers
+
+
+# Fraction of each event that is logged; events not listed are always logged
+SAMPLE_RATES = {
+    "trends.top_queries": 0.1,
+    "trends.timelines": 0.1,
+    "expansion.added": 0.1,
+}
+MAX_PAYLOAD = 2048 # Characters of a payload that make it into the log
+QUEUE_SIZE = 10000 # Records waiting for the writer thread; more are dropped rather than blocking a request
+
+_lock = threading.Lock()
+_listener = None
+_sample_rates = dict(SAMPLE_RATES)
+_max_payload = MAX_PAYLOAD
+
+
+"""
+One JSON object per line with the time, level, logger, thread and message of a record, plus the event name and
+fields passed to log_event. Payloads are serialized here, on the writer thread, and cut to MAX_PAYLOAD characters.
+"""
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", None) or {})
+        if hasattr(record, "payload"):
+            payload = json.dumps(record.payload, default=str)
+            if len(payload) > _max_payload:
+                entry["payload_size"] = len(payload)
+                payload = payload[:_max_payload]
+                entry["payload_truncated"] = True
+            entry["payload"] = payload
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+"""
+Hands records to the writer thread without formatting them on the calling thread, and drops them when
+the queue is full instead of blocking
+"""
+class _BackgroundHandler(logging.handlers.QueueHandler):
+
+    def __init__(self, log_queue):
+        super(_BackgroundHandler, self).__init__(log_queue)
+        self.dropped = 0
+
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        # Merge the arguments now, they may change once the caller moves on
+        record.msg, record.args = record.getMessage(), None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+"""
+Send every log record of the process to PATH as JSON lines, written by a background thread.
+Only the first call does anything, and nothing is changed when the application configured logging itself.
+SAMPLE_RATES overrides the fraction of each event that log_event keeps, MAX_PAYLOAD the characters kept of each payload.
+"""
+def configure(path="log/simulation.jsonl", level=logging.INFO, sample_rates=None, max_payload=None):
+    global _listener, _max_payload
+    with _lock:
+        root = logging.getLogger()
+        if _listener is not None or root.handlers:
+            return
+        if sample_rates:
+            _sample_rates.update(sample_rates)
+        if max_payload is not None:
+            _max_payload = max_payload
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        file_handler = logging.FileHandler(path)
+        file_handler.setFormatter(JsonFormatter())
+        log_queue = queue.Queue(QUEUE_SIZE)
+        root.addHandler(_BackgroundHandler(log_queue))
+        root.setLevel(level)
+        _listener = logging.handlers.QueueListener(log_queue, file_handler, respect_handler_level=True)
+        _listener.start()
+        atexit.register(shutdown)
+
+
+"""
+Write out what is still queued and stop the writer thread
+"""
+def shutdown():
+    global _listener
+    with _lock:
+        if _listener is None:
+            return
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            if isinstance(handler, _BackgroundHandler):
+                root.removeHandler(handler)
+        _listener = None
+
+
+"""
+Log EVENT with FIELDS as a structured record, keeping only the sampled fraction of it (see SAMPLE_RATES).
+PAYLOAD (e.g. an API response) is only serialized, and cut to size, on the writer thread.
+"""
+def log_event(event, message=None, level=logging.INFO, payload=None, logger=None, **fields):
+    logger = logger or logging.getLogger()
+    if not logger.isEnabledFor(level):
+        return
+    rate = _sample_rates.get(event, 1.0)
+    if rate < 1.0 and random.random() >= rate:
+        return
+    fields["event"] = event
+    if rate < 1.0:
+        fields["sample_rate"] = rate
+    extra = {"fields": fields}
+    if payload is not None:
+        extra["payload"] = payload
+    logger.log(level, message or event, extra=extra)
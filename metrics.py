@@ -0,0 +1,231 @@
+import os
+import json
+import time
+import threading
+import contextlib
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float("inf"))
+
+
+"""
+Cumulative histogram with fixed upper bounds, like a Prometheus histogram
+"""
+class Histogram(object):
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+
+
+    """
+    Estimate of quantile Q, interpolated inside the bucket it falls in
+    """
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        lower = 0.0
+        for bound, count in zip(self.buckets, self.counts):
+            if count and seen + count >= rank:
+                if bound == float("inf"):
+                    return lower
+                return lower + (bound - lower) * (rank - seen) / count
+            seen += count
+            lower = bound if bound != float("inf") else lower
+        return lower
+
+
+"""
+Process wide counters, gauges, histograms and optional tracing spans.
+Metrics are identified by a name and a set of labels, e.g. inc("trends_responses_total", endpoint="getTopQueries", status=429).
+At the end of a run they are written as a Prometheus text file and a JSON summary.
+"""
+class MetricsRegistry(object):
+
+    def __init__(self, tracing=False):
+        self.tracing = tracing
+        self.counters = dict()
+        self.gauges = dict()
+        self.histograms = dict()
+        self.spans = []
+        self._started = time.time()
+        self._lock = threading.Lock()
+
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+
+    def inc(self, name, value=1, **labels):
+        key = MetricsRegistry._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+
+    """
+    Sum of counter NAME over all its labels
+    """
+    def total(self, name):
+        with self._lock:
+            return sum(value for (metric, _), value in self.counters.items() if metric == name)
+
+
+    def set_gauge(self, name, value, **labels):
+        key = MetricsRegistry._key(name, labels)
+        with self._lock:
+            self.gauges[key] = value
+
+
+    def observe(self, name, value, **labels):
+        key = MetricsRegistry._key(name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+
+    """
+    Observe how long the block takes, in seconds, into histogram NAME
+    """
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+
+    """
+    Record a tracing span for the block when tracing is on, e.g. one per seed and location
+    """
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        if not self.tracing:
+            yield
+            return
+        start = time.time()
+        error = None
+        try:
+            yield
+        except Exception as e:
+            error = repr(e)
+            raise
+        finally:
+            span = {"name": name, "start": start, "duration": time.time() - start, "thread": threading.current_thread().name}
+            span.update(attributes)
+            if error is not None:
+                span["error"] = error
+            with self._lock:
+                self.spans.append(span)
+
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+            del self.spans[:]
+            self._started = time.time()
+
+
+    @staticmethod
+    def _labels_text(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join('{}="{}"'.format(label, value.replace('"', '\\"')) for label, value in pairs) + "}"
+
+
+    """
+    Every metric in the Prometheus text exposition format
+    """
+    def prometheus_text(self):
+        lines = []
+        with self._lock:
+            for kind, metrics in (("counter", self.counters), ("gauge", self.gauges)):
+                for name in sorted(set(name for name, _ in metrics)):
+                    lines.append("# TYPE {} {}".format(name, kind))
+                    for (metric, labels), value in sorted(metrics.items()):
+                        if metric == name:
+                            lines.append("{}{} {}".format(name, MetricsRegistry._labels_text(labels), value))
+            for name in sorted(set(name for name, _ in self.histograms)):
+                lines.append("# TYPE {} histogram".format(name))
+                for (metric, labels), histogram in sorted(self.histograms.items()):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        le = "+Inf" if bound == float("inf") else repr(bound)
+                        lines.append("{}_bucket{} {}".format(name, MetricsRegistry._labels_text(labels, [("le", le)]), cumulative))
+                    lines.append("{}_sum{} {}".format(name, MetricsRegistry._labels_text(labels), histogram.sum))
+                    lines.append("{}_count{} {}".format(name, MetricsRegistry._labels_text(labels), histogram.count))
+        return "\n".join(lines) + "\n"
+
+
+    """
+    JSON friendly summary: counter and gauge values, and count, mean, p50 and p99 of every histogram
+    """
+    def summary(self):
+        def name_of(name, labels):
+            return name + MetricsRegistry._labels_text(labels)
+
+        with self._lock:
+            return {
+                "elapsed_seconds": time.time() - self._started,
+                "counters": dict((name_of(*key), value) for key, value in sorted(self.counters.items())),
+                "gauges": dict((name_of(*key), value) for key, value in sorted(self.gauges.items())),
+                "histograms": dict((name_of(*key), {
+                    "count": histogram.count,
+                    "sum": histogram.sum,
+                    "mean": histogram.sum / histogram.count if histogram.count else None,
+                    "p50": histogram.quantile(0.5),
+                    "p99": histogram.quantile(0.99),
+                }) for key, histogram in sorted(self.histograms.items())),
+                "spans": list(self.spans),
+            }
+
+
+    """
+    Write metrics.prom and metrics.json into DIRECTORY
+    """
+    def write(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, "metrics.prom"), "w") as prometheus_file:
+            prometheus_file.write(self.prometheus_text())
+        with open(os.path.join(directory, "metrics.json"), "w") as summary_file:
+            json.dump(self.summary(), summary_file, indent=2)
+
+
+# Registry the simulation modules report to
+REGISTRY = MetricsRegistry()
+
+
+"""
+Decorator that times every call of a function into histogram NAME of the default registry
+"""
+def timed(name, **labels):
+    def decorator(function):
+        def wrapper(*args, **kwargs):
+            with REGISTRY.timer(name, **labels):
+                return function(*args, **kwargs)
+        wrapper.__name__ = function.__name__
+        wrapper.__doc__ = function.__doc__
+        return wrapper
+    return decorator
@@ -0,0 +1,140 @@
+import os
+import uuid
+import logging
+import datetime
+import threading
+from urllib.parse import quote
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.dataset as ds
+
+
+# Fixed schemas for the datasets the simulation writes, so files from different runs can be scanned together
+SCHEMAS = {
+    "top_queries": pa.schema([
+        ("initial_search_term", pa.string()),
+        ("start_date", pa.string()),
+        ("end_date", pa.string()),
+        ("query", pa.string()),
+        ("value", pa.float64()),
+        ("level", pa.int32()),
+        ("parent", pa.string()),
+    ]),
+    "relative_search_volume": pa.schema([
+        ("term", pa.string()),
+        ("relative_search_volume", pa.float64()),
+        ("start_date", pa.string()),
+        ("end_date", pa.string()),
+    ]),
+    "search_results": pa.schema([
+        ("query", pa.string()),
+        ("position", pa.int32()),
+        ("link", pa.string()),
+        ("displayLink", pa.string()),
+        ("site_probability", pa.float64()),
+    ]),
+}
+
+PARTITIONING = ds.partitioning(pa.schema([
+    ("seed", pa.string()), ("geo", pa.string()), ("run_id", pa.string()),
+]), flavor="hive")
+
+
+"""
+Append-only Parquet dataset for simulation output, laid out as
+ROOT/<dataset>/seed=<seed term>/geo=<geo code>/run_id=<run id>/part-<n>.parquet
+Rows are buffered per partition and written BATCH_SIZE at a time, or when a partition is flushed. Every file name is unique,
+so runs never overwrite each other. Safe to share between threads.
+"""
+class OutputStore(object):
+    ROOT = "output/dataset"
+
+    def __init__(self, root=ROOT, run_id=None, batch_size=50000):
+        self.root = root
+        self.run_id = run_id or datetime.datetime.now().strftime('%Y-%m-%dT%H%M%S') + "-" + uuid.uuid4().hex[:8]
+        self.batch_size = batch_size
+        self._buffers = dict()
+        self._parts = dict()
+        self._lock = threading.Lock()
+
+
+    def _partition_dir(self, dataset, seed, geo):
+        return os.path.join(
+            self.root, dataset,
+            "seed=" + quote(seed, safe=""), "geo=" + quote(geo, safe=""), "run_id=" + quote(self.run_id, safe="")
+        )
+
+
+    """
+    Queue ROWS (a list of dicts) for DATASET under the SEED and GEO partition
+    """
+    def append(self, dataset, seed, geo, rows):
+        key = (dataset, seed, geo)
+        with self._lock:
+            buffer = self._buffers.setdefault(key, [])
+            buffer.extend(rows)
+            if len(buffer) >= self.batch_size:
+                self._write(key, self._buffers.pop(key))
+
+
+    def _write(self, key, rows):
+        dataset, seed, geo = key
+        directory = self._partition_dir(dataset, seed, geo)
+        os.makedirs(directory, exist_ok=True)
+        part = self._parts.get(key, 0)
+        self._parts[key] = part + 1
+        table = pa.Table.from_pylist(rows, schema=SCHEMAS.get(dataset))
+        path = os.path.join(directory, "part-{:05d}-{}.parquet".format(part, uuid.uuid4().hex[:8]))
+        pq.write_table(table, path)
+        logging.info("Wrote {} {} rows to {}".format(len(rows), dataset, path))
+
+
+    """
+    Write out every buffered row, or only the rows of the SEED and GEO partitions
+    """
+    def flush(self, seed=None, geo=None):
+        with self._lock:
+            keys = [key for key in self._buffers if (seed is None or key[1] == seed) and (geo is None or key[2] == geo)]
+            for key in keys:
+                rows = self._buffers.pop(key)
+                if rows:
+                    self._write(key, rows)
+
+
+    def close(self):
+        self.flush()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+"""
+Open DATASET under ROOT for scanning across every seed, geo and run.
+The partition columns seed, geo and run_id can be used in filters, for example
+read_dataset("top_queries", filter=ds.field("geo") == "US").to_pandas()
+"""
+def open_dataset(dataset, root=OutputStore.ROOT):
+    return ds.dataset(
+        os.path.join(root, dataset), format="parquet", partitioning=PARTITIONING, schema=_dataset_schema(dataset)
+    )
+
+
+def _dataset_schema(dataset):
+    schema = SCHEMAS.get(dataset)
+    if schema is None:
+        return None
+    for field in PARTITIONING.schema:
+        schema = schema.append(field)
+    return schema
+
+
+"""
+Read DATASET into one pyarrow Table, optionally restricted to COLUMNS and rows matching FILTER
+"""
+def read_dataset(dataset, root=OutputStore.ROOT, columns=None, filter=None):
+    return open_dataset(dataset, root).to_table(columns=columns, filter=filter)
@@ -0,0 +1,224 @@
+import time
+import queue
+import logging
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from google_client import GoogleClient
+import search
+import metrics
+
+
+# Marks the end of a stage's output
+_DONE = object()
+
+
+class PipelineCancelled(Exception):
+    pass
+
+
+"""
+Streaming mode for one simulation: keyword expansion, timelines and site search run as stages connected by
+bounded queues instead of one after another.
+Level 1 queries go to the timelines stage as soon as they are known and are requested in batches of
+TIMELINE_BATCH_SIZE while deeper levels are still being expanded. Every batch is anchored on the term with the
+most volume in the first batch, like GoogleClient.get_timelines_matrix, and goes through the journal and date sharding (see
+Simulation.get_timelines_batch). The volumes it yields go straight to site search.
+A full queue blocks the stage feeding it, so a slow stage holds back the ones before it instead of piling up work.
+Shares of the total volume need every term, so they (and site probabilities) are normalized once at the end.
+"""
+class StreamingPipeline(object):
+    QUEUE_SIZE = 64
+    SEARCH_WORKERS = 4
+
+    def __init__(self, simulation, fetcher=None, max_depth=None, queue_size=QUEUE_SIZE, search_workers=SEARCH_WORKERS, expansion=None):
+        self.simulation = simulation
+        # Extra options for Simulation.expand_queries, e.g. best first expansion
+        self.expansion = expansion or {}
+        self.fetcher = fetcher or search.SiteSearchFetcher()
+        self.max_depth = max_depth
+        self.queue_size = queue_size
+        self.search_workers = search_workers
+        self._cancelled = threading.Event()
+        self._errors = []
+
+
+    def _put(self, name, stage_queue, item):
+        while True:
+            if self._cancelled.is_set():
+                raise PipelineCancelled()
+            try:
+                stage_queue.put(item, timeout=0.1)
+                metrics.REGISTRY.set_gauge("pipeline_queue_depth", stage_queue.qsize(), queue=name)
+                return
+            except queue.Full:
+                continue
+
+
+    """
+    Items put on STAGE_QUEUE until the stage feeding it is done
+    """
+    def _drain(self, stage_queue):
+        while True:
+            try:
+                item = stage_queue.get(timeout=0.1)
+            except queue.Empty:
+                if self._cancelled.is_set():
+                    raise PipelineCancelled()
+                continue
+            if item is _DONE:
+                return
+            yield item
+
+
+    def _run_stage(self, target, name, output_queue, *args):
+        try:
+            target(*args)
+        except PipelineCancelled:
+            pass
+        except Exception as e:
+            logging.exception("Pipeline stage {} failed".format(name))
+            self._errors.append(e)
+            self._cancelled.set()
+        finally:
+            if output_queue is not None:
+                try:
+                    self._put(name, output_queue, _DONE)
+                except PipelineCancelled:
+                    pass
+
+
+    """
+    Top queries for the seed term; level 1 queries are passed on before the deeper levels are expanded
+    """
+    def _expand(self, terms_queue):
+        simulation = self.simulation
+        try:
+            simulation.get_topics()
+            simulation.get_queries()
+            for query in simulation.keywords.queries(level=1):
+                self._put("terms", terms_queue, query)
+        finally:
+            try:
+                self._put("terms", terms_queue, _DONE)
+            except PipelineCancelled:
+                pass
+        simulation.expand_queries(self.max_depth, **self.expansion)
+
+
+    """
+    Request timelines for terms in anchored batches as they arrive and pass on the volume of every term,
+    on the scale of the first batch
+    """
+    def _timelines(self, terms_queue, volumes_queue):
+        simulation = self.simulation
+        block = GoogleClient.TIMELINE_BATCH_SIZE
+        anchor, reference = None, None
+
+        def request(batch):
+            nonlocal anchor, reference
+            request_terms = batch if anchor is None else [anchor] + batch
+            timelines = simulation.get_timelines_batch(request_terms, reference)
+            if timelines is None:
+                logging.warning("Not enough timeline data for {}, they are left out".format(batch))
+                return
+            dates, matrix = timelines
+            if anchor is None:
+                # Later batches carry the term with the most volume, like GoogleClient.get_timelines_matrix
+                row = int(matrix.sum(axis=1).argmax())
+                anchor, reference = request_terms[row], float(matrix[row].sum())
+            first = len(request_terms) - len(batch)
+            for term, volume in zip(batch, matrix[first:].sum(axis=1)):
+                self._put("volumes", volumes_queue, (term, float(volume)))
+
+        batch = []
+        for term in self._drain(terms_queue):
+            batch.append(term)
+            # The first batch sets the anchor, every later one carries it along
+            if len(batch) == (block if anchor is None else block - 1):
+                request(batch)
+                batch = []
+        if batch:
+            request(batch)
+
+
+    """
+    Search every term as soon as its volume is known, up to SEARCH_WORKERS at a time, and pass on
+    (term, volume, items); items is None for terms that could not be searched
+    """
+    def _search(self, volumes_queue, results_queue):
+        with ThreadPoolExecutor(max_workers=self.search_workers) as executor:
+            pending = collections.deque()
+
+            def emit():
+                term, volume, future = pending.popleft()
+                self._put("results", results_queue, (term, volume, future.result()))
+
+            for term, volume in self._drain(volumes_queue):
+                pending.append((term, volume, executor.submit(self.fetcher.fetch, term)))
+                while len(pending) > self.search_workers or (pending and pending[0][2].done()):
+                    emit()
+            while pending:
+                emit()
+
+
+    """
+    Run the stages and yield (term, volume, items) as each term's search finishes.
+    Volumes are on the scale of the first timeline batch, not yet shares of the total.
+    """
+    def stream(self):
+        terms_queue = queue.Queue(self.queue_size)
+        volumes_queue = queue.Queue(self.queue_size)
+        results_queue = queue.Queue(self.queue_size)
+        stages = [
+            threading.Thread(target=self._run_stage, args=(self._expand, "expand", None, terms_queue)),
+            threading.Thread(target=self._run_stage, args=(self._timelines, "timelines", volumes_queue, terms_queue, volumes_queue)),
+            threading.Thread(target=self._run_stage, args=(self._search, "search", results_queue, volumes_queue, results_queue)),
+        ]
+        for stage in stages:
+            stage.start()
+        try:
+            for result in self._drain(results_queue):
+                yield result
+            # Expansion of the deeper levels can outlast the other stages
+            stages[0].join()
+        except PipelineCancelled:
+            pass
+        finally:
+            if any(stage.is_alive() for stage in stages[1:]):
+                self._cancelled.set()
+            for stage in stages:
+                stage.join()
+        if self._errors:
+            raise self._errors[0]
+
+
+    """
+    Run the simulation in streaming mode. Sets the simulation's relative search volumes, writes the search
+    results (see search.write_results) and returns the terms that could not be searched.
+    """
+    @metrics.timed("stage_seconds", stage="pipeline")
+    def run(self, output_store=None):
+        simulation = self.simulation
+        started = time.perf_counter()
+        volumes = collections.OrderedDict()
+        searched, remaining = [], []
+        for term, volume, items in self.stream():
+            if not volumes:
+                metrics.REGISTRY.observe("pipeline_first_result_seconds", time.perf_counter() - started)
+            volumes[term] = volume
+            if items is None:
+                remaining.append(term)
+            else:
+                searched.append((term, items))
+
+        # Same normalization as GoogleClient._average, in the order Google returned the level 1 queries
+        terms = [query for query in simulation.keywords.queries(level=1) if query in volumes]
+        total = sum(volumes.values())
+        shares = dict((term, volumes[term] / total if total > 0 else volumes[term]) for term in terms)
+        simulation.relative_search_volumes = [{term: shares[term]} for term in terms]
+        if remaining:
+            logging.warning("{} terms were not searched: {}".format(len(remaining), remaining))
+        rows = search.result_rows(simulation.initial_search_term, searched, shares)
+        search.write_results(rows, simulation.initial_search_term, simulation.geoLocation['code'], output_store)
+        return remaining
@@ -0,0 +1,103 @@
+import threading
+from single_flight import SingleFlight
+
+
+# Common English stopwords, for policies that should treat "meals for kids" and "meals kids" alike
+STOPWORDS = frozenset([
+    "a", "an", "and", "are", "at", "by", "for", "from", "in", "is", "it", "of", "on", "or", "the", "to", "with",
+])
+
+# Words that end like plurals but are not, so plural folding leaves them alone ("hiv aids" is not "hiv aid")
+NOT_PLURALS = frozenset([
+    "aids", "news", "diabetes", "measles", "mumps", "rabies", "scabies", "herpes", "shingles", "rickets", "lupus",
+    "tetanus", "pertussis", "arthritis", "hepatitis", "clothes", "series", "species", "texas", "illinois", "kansas",
+    "arkansas", "los", "las", "christmas",
+])
+
+
+"""
+How queries are reduced to a canonical form before they are compared.
+By default case and whitespace are ignored, so "Food Banks  near me" and "food banks near me" are the same query.
+With FOLD_PLURALS plural words are folded to their singular form as well ("food bank near me"), except for
+words in NOT_PLURALS. It is off by default since it can merge queries that mean different things.
+Stopword folding is off unless STOPWORDS are given.
+"""
+class NormalizationPolicy(object):
+
+    def __init__(self, lowercase=True, collapse_whitespace=True, fold_plurals=False, stopwords=()):
+        self.lowercase = lowercase
+        self.collapse_whitespace = collapse_whitespace
+        self.fold_plurals = fold_plurals
+        self.stopwords = frozenset(stopwords)
+
+
+    """
+    Singular form of a single WORD, using simple English suffix rules
+    """
+    @staticmethod
+    def singular(word):
+        if word in NOT_PLURALS:
+            return word
+        if len(word) > 4 and word.endswith("ies"):
+            return word[:-3] + "y"
+        if len(word) > 4 and word.endswith(("sses", "shes", "ches", "xes")):
+            return word[:-2]
+        if len(word) > 3 and word.endswith("s") and not word.endswith(("ss", "us", "is")):
+            return word[:-1]
+        return word
+
+
+    def canonical(self, query):
+        if self.lowercase:
+            query = query.lower()
+        words = query.split() if self.collapse_whitespace else query.split(" ")
+        if self.stopwords:
+            words = [word for word in words if word not in self.stopwords] or words
+        if self.fold_plurals:
+            words = [NormalizationPolicy.singular(word) for word in words]
+        return " ".join(words)
+
+
+"""
+Query index shared by every seed, location and level of a run.
+It maps the canonical form of a query to the top queries already fetched for it, keyed by geo and window since
+Google answers differently per location and period. Expansion asks the index first and only pays for new queries.
+"""
+class QueryIndex(object):
+
+    def __init__(self, policy=None):
+        self.policy = policy or NormalizationPolicy()
+        self.hits = 0
+        self.misses = 0
+        self._results = dict()
+        self._lock = threading.Lock()
+        self._in_flight = SingleFlight()
+
+
+    def canonical(self, query):
+        return self.policy.canonical(query)
+
+
+    """
+    Result for QUERY in GEO and the window, calling FETCH only if no equivalent query was fetched before
+    """
+    def get_or_fetch(self, query, geo, startDate, endDate, fetch):
+        key = (self.canonical(query), geo, startDate, endDate)
+        with self._lock:
+            result = self._results.get(key)
+            if result is not None:
+                self.hits += 1
+                return result
+            self.misses += 1
+        # Equivalent queries asked for at the same moment (e.g. "Food Bank" and "food bank") wait on one fetch
+        result, _ = self._in_flight.do(key, fetch)
+        if result is not None:
+            # None is a failed fetch, the next equivalent query tries again
+            with self._lock:
+                self._results.setdefault(key, result)
+        return result
+
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._results)}
@@ -0,0 +1,248 @@
+import time
+import socket
+import random
+import logging
+import threading
+import contextlib
+import email.utils
+import httplib2
+from googleapiclient.errors import HttpError
+import metrics
+
+
+"""
+Thread safe token bucket.
+Tokens refill at RATE per second up to CAPACITY, every request takes one token and waits if none are left.
+"""
+class TokenBucket(object):
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1.0, rate))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+    """
+    Block until a token is available and take it
+    """
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                elif self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                else:
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+    """
+    Stop handing out tokens for SECONDS, used when the server tells every caller to back off
+    """
+    def pause(self, seconds):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0
+
+
+class CallBudgetExhausted(Exception):
+    pass
+
+
+# Budget the calls of each thread are charged to, see CallBudget.charging
+_charged = threading.local()
+
+
+"""
+Requests that may still go out to Google for one piece of work, e.g. the expansion of a seed term in all of its
+locations. A call is charged only when it is made inside charging() on the same thread and reaches the network
+(see GoogleClient._fetch), answers from the cache cost nothing. Once LIMIT calls are spent, spend raises
+CallBudgetExhausted instead of letting the call through.
+"""
+class CallBudget(object):
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.calls = 0
+        self._lock = threading.Lock()
+
+
+    """
+    Take one call from the budget
+    """
+    def spend(self):
+        with self._lock:
+            if self.calls >= self.limit:
+                raise CallBudgetExhausted("Call budget of {} is used up".format(self.limit))
+            self.calls += 1
+
+
+    @property
+    def exhausted(self):
+        with self._lock:
+            return self.calls >= self.limit
+
+
+    """
+    Charge the calls the calling thread makes in the block to this budget
+    """
+    @contextlib.contextmanager
+    def charging(self):
+        previous = getattr(_charged, "budget", None)
+        _charged.budget = self
+        try:
+            yield
+        finally:
+            _charged.budget = previous
+
+
+    """
+    Budget the calling thread is charged to, None outside charging()
+    """
+    @staticmethod
+    def current():
+        return getattr(_charged, "budget", None)
+
+
+"""
+Central scheduler every GoogleClient request goes through.
+Requests are paced by a shared token bucket. Throttled (429) and server error (5xx) responses are
+retried with jittered exponential backoff, honouring Retry-After when Google sends it, for at most
+MAX_ATTEMPTS attempts. Transport errors (timeouts, dropped connections, failed DNS lookups) are retried
+the same way. After that the error is raised so the caller knows the batch failed.
+"""
+class RequestScheduler(object):
+    TRANSPORT_ERRORS = (socket.timeout, ConnectionError, httplib2.ServerNotFoundError)
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, rate=5.0, burst=None, max_attempts=8, base_delay=1.0, max_delay=64.0):
+        self.bucket = TokenBucket(rate, burst)
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.requests = 0
+        self.retries = 0
+        self.throttled = 0
+        self.server_errors = 0
+        self.transport_errors = 0
+        self._lock = threading.Lock()
+
+
+    """
+    Process wide scheduler, so every client in the process draws from the same quota
+    """
+    @classmethod
+    def shared(cls):
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+
+    @staticmethod
+    def _is_retryable(status):
+        return status == 429 or (status // 100) == 5
+
+
+    """
+    Seconds the server asked us to wait, or None if it did not say
+    """
+    @staticmethod
+    def _retry_after(error):
+        value = error.resp.get("retry-after") if error.resp is not None else None
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            retry_at = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        return max(0.0, retry_at.timestamp() - time.time())
+
+
+    """
+    Full jitter exponential backoff for the given attempt number
+    """
+    def _backoff(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** (attempt - 1))))
+
+
+    """
+    Run REQUEST (a callable that makes one API call) once a token is available, retrying as needed.
+    ENDPOINT labels the request in the metrics.
+    """
+    def execute(self, request, endpoint="unknown"):
+        attempt = 1
+        while True:
+            with metrics.REGISTRY.timer("rate_limiter_wait_seconds", endpoint=endpoint):
+                self.bucket.acquire()
+            with self._lock:
+                self.requests += 1
+            # Every attempt that reaches Google counts against the quota
+            metrics.REGISTRY.inc("api_quota_used_total", endpoint=endpoint)
+            try:
+                with metrics.REGISTRY.timer("api_request_seconds", endpoint=endpoint):
+                    response = request()
+                metrics.REGISTRY.inc("api_responses_total", endpoint=endpoint, status=200)
+                return response
+            except HttpError as e:
+                status = e.resp.status if e.resp is not None else 0
+                metrics.REGISTRY.inc("api_responses_total", endpoint=endpoint, status=status)
+                if not RequestScheduler._is_retryable(status) or attempt >= self.max_attempts:
+                    raise
+                retry_after = RequestScheduler._retry_after(e)
+                reason = status
+            except RequestScheduler.TRANSPORT_ERRORS as e:
+                status = "transport"
+                metrics.REGISTRY.inc("api_responses_total", endpoint=endpoint, status=status)
+                if attempt >= self.max_attempts:
+                    raise
+                retry_after = None
+                reason = repr(e)
+            metrics.REGISTRY.inc("api_retries_total", endpoint=endpoint, status=status)
+            with self._lock:
+                self.retries += 1
+                if status == 429:
+                    self.throttled += 1
+                elif status == "transport":
+                    self.transport_errors += 1
+                else:
+                    self.server_errors += 1
+            if retry_after is not None:
+                # Everyone is over the limit, not just this request
+                self.bucket.pause(retry_after)
+                delay = retry_after
+            else:
+                delay = self._backoff(attempt)
+            logging.info("Request failed with {}, retrying in {:.1f}s (attempt {} of {})".format(
+                reason, delay, attempt, self.max_attempts
+            ))
+            time.sleep(delay)
+            attempt += 1
+
+
+    def stats(self):
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "retries": self.retries,
+                "throttled": self.throttled,
+                "server_errors": self.server_errors,
+                "transport_errors": self.transport_errors,
+            }
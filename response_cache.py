@@ -0,0 +1,197 @@
+import os
+import json
+import time
+import hashlib
+import datetime
+import logging
+import sqlite3
+import threading
+import collections
+
+
+class CacheMiss(Exception):
+    pass
+
+
+"""
+True when a window ending at END_DATE ended before TODAY (a date, today when None).
+Dates are either YYYY-MM or YYYY-MM-DD, so we compare against today in the same format.
+"""
+def is_closed_window(end_date, today=None):
+    if not end_date:
+        return False
+    today = (today or datetime.date.today()).isoformat()
+    return end_date < today[:len(end_date)]
+
+
+"""
+Base class for caches of raw Trends API responses.
+Responses are keyed by the API method and its request parameters (terms, geo restriction and dates).
+Entries for a window that has already ended never expire, since Google will not change that data.
+Entries for a window that is still open expire after TTL seconds (None keeps them forever).
+With OFFLINE set, GoogleClient never goes to the network and a miss raises CacheMiss instead.
+"""
+class ResponseCache(object):
+
+    def __init__(self, ttl=24 * 60 * 60, max_entries=100000, offline=False):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.offline = offline
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+
+    """
+    Stable key for a METHOD and its request PARAMS
+    """
+    @staticmethod
+    def make_key(method, params):
+        payload = json.dumps([method, params], sort_keys=True, separators=(",", ":"))
+        return hashlib.sha1(payload.encode("utf8")).hexdigest()
+
+
+    """
+    True when the request window in PARAMS ended before today
+    """
+    @staticmethod
+    def _is_closed_window(params):
+        return is_closed_window(params.get("restrictions_endDate") or params.get("time_endDate"))
+
+
+    def _expires_at(self, params):
+        if self.ttl is None or ResponseCache._is_closed_window(params):
+            return None
+        return time.time() + self.ttl
+
+
+    """
+    Returns the cached response for METHOD and PARAMS, or None if we have not seen it
+    """
+    def get(self, method, params):
+        key = ResponseCache.make_key(method, params)
+        with self._lock:
+            response = self._get(key, time.time())
+            if response is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return response
+
+
+    def set(self, method, params, response):
+        key = ResponseCache.make_key(method, params)
+        with self._lock:
+            self._set(key, method, response, self._expires_at(params), time.time())
+
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "size": len(self)}
+
+
+    def _get(self, key, now):
+        raise NotImplementedError
+
+
+    def _set(self, key, method, response, expires, now):
+        raise NotImplementedError
+
+
+    def __len__(self):
+        raise NotImplementedError
+
+
+"""
+In-process cache, useful when several simulations share one client but nothing needs to persist.
+"""
+class MemoryResponseCache(ResponseCache):
+
+    def __init__(self, ttl=24 * 60 * 60, max_entries=100000, offline=False):
+        super(MemoryResponseCache, self).__init__(ttl, max_entries, offline)
+        self._entries = collections.OrderedDict()
+
+
+    def _get(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        response, expires = entry
+        if expires is not None and expires < now:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return response
+
+
+    def _set(self, key, method, response, expires, now):
+        self._entries[key] = (response, expires)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+"""
+Cache stored in a SQLite file on local disk so it survives between runs.
+Least recently used entries are evicted once the cache holds more than MAX_ENTRIES responses.
+"""
+class SQLiteResponseCache(ResponseCache):
+
+    def __init__(self, path, ttl=24 * 60 * 60, max_entries=100000, offline=False):
+        super(SQLiteResponseCache, self).__init__(ttl, max_entries, offline)
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.path = path
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, method TEXT, response TEXT, expires REAL, accessed REAL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self._connection.commit()
+
+
+    def _get(self, key, now):
+        row = self._connection.execute("SELECT response, expires FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        response, expires = row
+        if expires is not None and expires < now:
+            self._connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._connection.commit()
+            return None
+        self._connection.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+        self._connection.commit()
+        return json.loads(response)
+
+
+    def _set(self, key, method, response, expires, now):
+        self._connection.execute(
+            "INSERT OR REPLACE INTO responses (key, method, response, expires, accessed) VALUES (?, ?, ?, ?, ?)",
+            (key, method, json.dumps(response), expires, now)
+        )
+        overflow = len(self) - self.max_entries
+        if overflow > 0:
+            self._connection.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed LIMIT ?)",
+                (overflow,)
+            )
+            self.evictions += overflow
+            logging.info("Evicted {} responses from the cache".format(overflow))
+        self._connection.commit()
+
+
+    def __len__(self):
+        return self._connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
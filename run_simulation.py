@@ -0,0 +1,250 @@
+import os
+import sys
+import csv
+import json
+import logging
+import argparse
+import numpy as np
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+import simulate_keywords
+from google_client import GoogleClient
+from rate_limiter import CallBudget
+from response_cache import SQLiteResponseCache
+from output_store import OutputStore
+from journal import Journal
+from timeline_store import TimelineStore
+from query_index import QueryIndex, NormalizationPolicy, STOPWORDS
+from pipeline import StreamingPipeline
+import search
+import metrics
+import log_setup
+
+
+"""
+Read the locations we run the simulation for, see simulation_locations.csv
+"""
+def load_geolocations(locations_file=simulate_keywords.Simulation.LOCATIONS_FILE):
+    locations = []
+    with open(locations_file, "r") as csvfile:
+        reader = csv.DictReader(csvfile)
+        for row in reader:
+            code = row["geo_code"]
+            description = row["description"]
+            locations.append({"code": code, "description": description})
+    return locations
+
+
+"""
+Run the full simulation (keywords, relative search volumes and output) for one location
+Output goes to OUTPUT_STORE when one is given, otherwise to csv files.
+With STREAMING the stages run as a StreamingPipeline (see pipeline.py) that also searches every term with FETCHER.
+Without VOLUMES only the queries are collected, for when volumes come from master_list_timelines.
+EXPANSION holds extra options for Simulation.generate_keywords, e.g. {"best_first": True, "expansion_budget": 50}.
+"""
+def run_location(initial_search_term, loc, google_client, startDateTrends, endDateTrends, startDateTimelines, endDateTimelines, max_depth=None, output_store=None, journal=None, incremental=False, query_index=None, streaming=False, fetcher=None, volumes=True, expansion=None):
+    simulation = simulate_keywords.Simulation(
+        initial_search_term, loc, startDateTrends, endDateTrends, startDateTimelines, endDateTimelines,
+        google_client=google_client, journal=journal, incremental=incremental, query_index=query_index
+    )
+    if streaming and not volumes:
+        raise ValueError("Streaming needs the volumes of each location, it cannot leave them to the master list")
+    with metrics.REGISTRY.span("simulation", seed=initial_search_term, geo=loc['code']):
+        if streaming:
+            with metrics.REGISTRY.span("pipeline", seed=initial_search_term, geo=loc['code']):
+                StreamingPipeline(simulation, fetcher=fetcher, max_depth=max_depth, expansion=expansion).run(output_store)
+            if output_store is not None:
+                simulation.write_output(output_store)
+                output_store.flush(initial_search_term, loc['code'])
+            else:
+                simulation.generate_simulation_csvs()
+            return simulation
+        with metrics.REGISTRY.span("generate_keywords", seed=initial_search_term, geo=loc['code']):
+            simulation.generate_keywords(max_depth=max_depth, **(expansion or {}))
+        if volumes:
+            with metrics.REGISTRY.span("get_relative_search_volumes", seed=initial_search_term, geo=loc['code']):
+                simulation.get_relative_search_volumes()
+        if output_store is not None:
+            simulation.write_output(output_store)
+            # Written per location, so a run that dies later keeps what it finished
+            output_store.flush(initial_search_term, loc['code'])
+        else:
+            simulation.generate_simulation_csvs()
+    return simulation
+
+
+"""
+Generate master list of top queries for all geolocations during the specified time period
+Get relative search volume of top queries for initial search term
+Locations run on WORKERS threads that share GOOGLE_CLIENT, and with it the cache and the rate limiter.
+Locations that fail are logged and left out of the results. With a JOURNAL, running again picks up where they stopped.
+With best first EXPANSION, CALL_BUDGET caps the getTopQueries requests the expansion of the seed may send to Google,
+over all of its locations together; answers from the query index, journal or cache are free.
+Returns the master list, mapping every query to its highest value over the locations, and the volumes per geo code.
+"""
+def run_simulation(initial_search_term, locations, google_client, startDateTrends='2020-01', endDateTrends='2020-08', startDateTimelines='2020-01-01', endDateTimelines='2020-08-31', workers=4, max_depth=None, output_store=None, journal=None, incremental=False, query_index=None, streaming=False, fetcher=None, volumes=True, expansion=None, call_budget=None):
+    if expansion and call_budget is not None:
+        # One budget for the seed, every location draws from it
+        expansion = dict(expansion, call_budget=CallBudget(call_budget))
+    # Every top query of any location, with its highest value over the locations
+    master_list = dict()
+    relative_search_volumes = dict()
+
+    def run(loc):
+        try:
+            return run_location(
+                initial_search_term, loc, google_client,
+                startDateTrends, endDateTrends, startDateTimelines, endDateTimelines, max_depth, output_store,
+                journal, incremental, query_index, streaming, fetcher, volumes, expansion
+            )
+        except Exception:
+            logging.exception("Simulation for {} failed for {}".format(initial_search_term, loc['code']))
+            return None
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for loc, simulation in zip(locations, executor.map(run, locations)):
+            if simulation is None:
+                continue
+            for node in simulation.keywords.nodes(level=1):
+                query = simulation.keywords.query(node)
+                master_list[query] = max(master_list.get(query, 0.0), simulation.keywords.value(node))
+            relative_search_volumes[loc['code']] = simulation.relative_search_volumes
+    return master_list, relative_search_volumes
+
+
+"""
+Timelines of the whole MASTER_LIST in every location, as one TimelineTensor (terms x geos x dates).
+Every geo is asked for the same terms, so their shares can be compared across locations.
+MASTER_LIST maps every term to its highest top query value; terms are requested highest value first, so the
+batch the anchor is picked from (see GoogleClient.get_timelines_matrix) holds the terms most likely to have volume in every geo.
+The shares are appended to the relative_search_volume dataset of OUTPUT_STORE when one is given.
+"""
+def master_list_timelines(initial_search_term, master_list, locations, google_client, startDateTimelines, endDateTimelines, output_store=None):
+    terms = sorted(master_list, key=lambda term: (-master_list[term], term))
+    tensor = google_client.get_timelines_tensor(terms, locations, startDateTimelines, endDateTimelines)
+    shares = tensor.share()
+    relative_search_volumes = dict()
+    for geo_index, geo in enumerate(tensor.geos):
+        if np.isnan(shares[:, geo_index]).all():
+            continue
+        relative_search_volumes[geo] = [{term: float(share)} for term, share in zip(terms, shares[:, geo_index])]
+        if output_store is not None:
+            output_store.append("relative_search_volume", initial_search_term, geo, [{
+                "term": term,
+                "relative_search_volume": float(share),
+                "start_date": startDateTimelines,
+                "end_date": endDateTimelines,
+            } for term, share in zip(terms, shares[:, geo_index])])
+    if output_store is not None:
+        output_store.flush(initial_search_term)
+    return tensor, relative_search_volumes
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Run the keyword simulation for every location")
+    parser.add_argument("initial_search_terms", nargs="+", help="seed terms to run the simulation for")
+    parser.add_argument("--locations", default=simulate_keywords.Simulation.LOCATIONS_FILE, help="csv of geo_code,description")
+    parser.add_argument("--start-trends", default="2020-01")
+    parser.add_argument("--end-trends", default="2020-08")
+    parser.add_argument("--start-timelines", default="2020-01-01")
+    parser.add_argument("--end-timelines", default="2020-08-31")
+    parser.add_argument("--workers", type=int, default=4, help="locations simulated at the same time")
+    parser.add_argument("--max-depth", type=int, default=simulate_keywords.Simulation.MAX_DEPTH)
+    parser.add_argument("--cache", default=simulate_keywords.Simulation.CACHE_FILE, help="response cache file, '' disables it")
+    parser.add_argument("--offline", action="store_true", help="only answer from the response cache")
+    parser.add_argument("--journal", default=simulate_keywords.Simulation.JOURNAL_FILE, help="journal of finished work used to resume, '' disables it")
+    parser.add_argument("--incremental", action="store_true", help="extend journaled timelines instead of refetching the whole window")
+    parser.add_argument("--timelines", default=TimelineStore.ROOT, help="directory for raw timeline matrices, '' disables it")
+    parser.add_argument("--exact-queries", action="store_true", help="only treat identical strings as the same query")
+    parser.add_argument("--fold-plurals", action="store_true", help="also treat plural and singular words as the same when comparing queries")
+    parser.add_argument("--fold-stopwords", action="store_true", help="also ignore common stopwords when comparing queries")
+    parser.add_argument("--output", choices=["parquet", "csv"], default="parquet", help="parquet appends to " + OutputStore.ROOT)
+    parser.add_argument("--streaming", action="store_true", help="run expansion, timelines and site search as one streaming pipeline")
+    parser.add_argument("--search-quota", default=search.QUOTA_FILE, help="with --streaming, file counting today's Custom Search queries across runs, '' keeps the count per run")
+    parser.add_argument("--best-first", action="store_true", help="expand the most relevant queries first")
+    parser.add_argument("--min-value", type=float, default=0, help="with --best-first, do not expand queries with a lower value")
+    parser.add_argument("--expansion-budget", type=int, help="with --best-first, most queries expanded per seed and location, answers from the query index, journal and cache included")
+    parser.add_argument("--call-budget", type=int, help="with --best-first, most getTopQueries requests sent to Google per seed, shared by all its locations")
+    parser.add_argument("--master-list", action="store_true", help="fetch timelines of the merged master list for every location instead of per location")
+    parser.add_argument("--tensors", default="output/tensors", help="where --master-list saves each seed's terms x geos x dates tensor")
+    parser.add_argument("--log-file", default=simulate_keywords.Simulation.LOG_FILE, help="JSON lines log of the run")
+    parser.add_argument("--log-sample", action="append", default=[], metavar="EVENT=RATE", help="fraction of an event to log, e.g. trends.top_queries=0.5")
+    parser.add_argument("--metrics", default="output/metrics", help="directory for metrics.prom and metrics.json, '' disables them")
+    parser.add_argument("--trace", action="store_true", help="record a tracing span per seed, location and stage in metrics.json")
+    parser.add_argument("--summary", default="output/simulation_summary.json", help="where to write master lists and volumes")
+    args = parser.parse_args(argv)
+    if args.streaming and args.master_list:
+        # The pipeline searches every term with its own location's volumes, the master list replaces those afterwards
+        parser.error("--streaming and --master-list cannot be combined")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    log_setup.configure(args.log_file, sample_rates=dict(
+        (event, float(rate)) for event, rate in (sample.split("=", 1) for sample in args.log_sample)
+    ))
+    metrics.REGISTRY.tracing = args.trace
+    cache = SQLiteResponseCache(args.cache, offline=args.offline) if args.cache else None
+    timeline_store = TimelineStore(args.timelines) if args.timelines else None
+    google_client = GoogleClient(
+        simulate_keywords.Simulation.TRENDS_SERVER, simulate_keywords.Simulation.TRENDS_VERSION,
+        cache=cache, timeline_store=timeline_store
+    )
+    locations = load_geolocations(args.locations)
+    output_store = OutputStore() if args.output == "parquet" else None
+    journal = Journal(args.journal) if args.journal else None
+    if args.exact_queries:
+        policy = NormalizationPolicy(lowercase=False, collapse_whitespace=False)
+    else:
+        policy = NormalizationPolicy(fold_plurals=args.fold_plurals, stopwords=STOPWORDS if args.fold_stopwords else ())
+    query_index = QueryIndex(policy)
+    # One fetcher for every location, so they share the Custom Search quota
+    fetcher = search.SiteSearchFetcher(cache=cache, quota_path=args.search_quota or None) if args.streaming else None
+
+    expansion = {"best_first": True, "min_value": args.min_value, "expansion_budget": args.expansion_budget} if args.best_first else None
+    all_master_lists = dict()
+    all_relative_search_volumes = dict()
+    try:
+        for initial_search_term in args.initial_search_terms:
+            master_list, relative_search_volumes = run_simulation(
+                initial_search_term, locations, google_client,
+                args.start_trends, args.end_trends, args.start_timelines, args.end_timelines,
+                workers=args.workers, max_depth=args.max_depth, output_store=output_store,
+                journal=journal, incremental=args.incremental, query_index=query_index,
+                streaming=args.streaming, fetcher=fetcher, volumes=not args.master_list, expansion=expansion,
+                call_budget=args.call_budget
+            )
+            if args.master_list:
+                tensor, relative_search_volumes = master_list_timelines(
+                    initial_search_term, master_list, [loc for loc in locations if loc['code'] in relative_search_volumes],
+                    google_client, args.start_timelines, args.end_timelines, output_store
+                )
+                tensor.save(os.path.join(args.tensors, quote(initial_search_term, safe="") + ".npz"))
+            all_master_lists[initial_search_term] = sorted(master_list)
+            all_relative_search_volumes[initial_search_term] = relative_search_volumes
+    finally:
+        # Whatever was finished is kept, also when the run dies on an error or is interrupted
+        if output_store is not None:
+            output_store.close()
+        if journal is not None:
+            journal.close()
+    simulate_keywords.Simulation.mkdir_p(os.path.dirname(args.summary) or ".")
+    with open(args.summary, "w") as summary_file:
+        json.dump({
+            "master_lists": all_master_lists,
+            "relative_search_volumes": all_relative_search_volumes,
+        }, summary_file, indent=2)
+    if cache is not None:
+        logging.info("Response cache: {}".format(cache.stats()))
+    logging.info("Query index: {}".format(query_index.stats()))
+    logging.info("Coalesced calls: {}".format(google_client.in_flight.stats()))
+    if args.metrics:
+        metrics.REGISTRY.write(args.metrics)
+
+    failed = sum(len(locations) - len(volumes) for volumes in all_relative_search_volumes.values())
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,62 +4,285 @@ import requests
 import json
 import datetime
 import csv
+import logging
+import threading
+import contextlib
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import simulate_keywords
+import metrics
+try:
+    import fcntl
+except ImportError: # Windows, runs in separate processes are not kept apart there
+    fcntl = None
+
+SEARCH_URL = "https://www.googleapis.com/customsearch/v1"
+SEARCH_CX = "007577961584064119408:0r-ks0pzwfw"
+DAILY_QUOTA = 100 # Custom Search queries we may make per day
+QUOTA_FILE = "journal/search_quota.json" # Today's Custom Search count, shared by every run
+
+# Site probabilities by result position (1 to 10) are determined by Chitika study
+# For reference, please see methodology paper
+SITE_PROBABILITIES = np.array([0.35, 0.20, 0.15, 0.08, 0.07, 0.05, 0.04, 0.03, 0.02, 0.01])
+
+
+"""
+Counts calls made today against DAILY_LIMIT, Custom Search queries by default.
+With a PATH the count is kept on disk and read back and updated under a file lock on every call, so separate runs
+(and processes) on the same day share the quota and together never go over it.
+"""
+class QuotaTracker(object):
+
+    def __init__(self, daily_limit=DAILY_QUOTA, path=None):
+        self.daily_limit = daily_limit
+        self.path = path
+        self.day = datetime.date.today().isoformat()
+        self.used = 0 # Today's count over every run sharing PATH, as last read
+        self.spent = 0 # Calls taken by this tracker
+        self.exhausted = False
+        self._lock = threading.Lock()
+        with self._locked():
+            self._load()
+
+
+    """
+    Hold the thread lock and, with a PATH, an exclusive lock on PATH.lock that other processes wait for
+    """
+    @contextlib.contextmanager
+    def _locked(self):
+        with self._lock:
+            if not self.path or fcntl is None:
+                yield
+                return
+            simulate_keywords.Simulation.mkdir_p(os.path.dirname(self.path) or ".")
+            with open(self.path + ".lock", "w") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+    def _load(self):
+        today = datetime.date.today().isoformat()
+        if today != self.day:
+            self.day, self.used, self.exhausted = today, 0, False
+        if self.path and os.path.exists(self.path):
+            with open(self.path, "r") as quota_file:
+                saved = json.load(quota_file)
+            if saved.get("date") == self.day:
+                self.used = saved.get("used", 0)
+
+
+    def _save(self):
+        if self.path:
+            temporary_path = self.path + ".tmp"
+            with open(temporary_path, "w") as quota_file:
+                json.dump({"date": self.day, "used": self.used}, quota_file)
+            os.replace(temporary_path, self.path)
+
+
+    """
+    Take one call from today's quota, returns False once it is used up
+    """
+    def acquire(self):
+        with self._locked():
+            self._load()
+            if self.exhausted or self.used >= self.daily_limit:
+                self.exhausted = True
+                return False
+            self.used += 1
+            self.spent += 1
+            self._save()
+            return True
+
+
+    """
+    Google told us we are over quota, whatever our own count says
+    """
+    def mark_exhausted(self):
+        with self._lock:
+            self.exhausted = True
+
+
+    @property
+    def remaining(self):
+        with self._locked():
+            self._load()
+            return max(0, self.daily_limit - self.used)
+
+
+"""
+urllib3 Retry that counts every retry it allows in the metrics, the connection pool retries out of our sight otherwise.
+Like RequestScheduler it also takes fractional Retry-After seconds.
+"""
+class CountingRetry(Retry):
+
+    def parse_retry_after(self, retry_after):
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            return super(CountingRetry, self).parse_retry_after(retry_after)
+
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        retry = super(CountingRetry, self).increment(method, url, response, error, _pool, _stacktrace)
+        metrics.REGISTRY.inc("search_retries_total", status=response.status if response is not None else "transport")
+        return retry
+
+
+"""
+Fetches Custom Search results for many queries over one pooled requests.Session.
+Up to MAX_WORKERS requests run at once, 429 and 5xx responses are retried with backoff by the connection pool,
+results are kept in CACHE (a ResponseCache) keyed by query, and QUOTA stops the run cleanly once the daily quota is spent.
+Without a QUOTA the count is kept in QUOTA_PATH, so runs on the same day share it, None keeps it in memory only.
+"""
+class SiteSearchFetcher(object):
+
+    def __init__(self, key=None, cx=SEARCH_CX, search_url=SEARCH_URL, max_workers=8, cache=None, quota=None, quota_path=QUOTA_FILE):
+        self.key = key if key is not None else os.environ.get('SEARCH_DEVELOPER_KEY', "")
+        self.cx = cx
+        self.search_url = search_url
+        self.max_workers = max_workers
+        self.cache = cache
+        self.quota = quota or QuotaTracker(path=quota_path)
+        self.session = requests.Session()
+        retries = CountingRetry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["GET"], raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers, max_retries=retries)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+
+    """
+    One Custom Search request for PARAMS, retries included
+    """
+    def _request(self, params):
+        with metrics.REGISTRY.timer("search_request_seconds"):
+            return self.session.get(self.search_url, params=dict(params, key=self.key))
+
+
+    """
+    Search result items for QUERY, [] when there are none, or None when the query could not be made
+    because we are out of quota or the request failed
+    """
+    def fetch(self, query):
+        params = {"q": query, "cx": self.cx}
+        if self.cache is not None:
+            data = self.cache.get("customsearch", params)
+            if data is not None:
+                metrics.REGISTRY.inc("search_cache_total", result="hit")
+                return data.get("items", [])
+            metrics.REGISTRY.inc("search_cache_total", result="miss")
+            if self.cache.offline:
+                return None
+        if not self.quota.acquire():
+            return None
+        metrics.REGISTRY.set_gauge("search_quota_used", self.quota.used)
+        try:
+            response = self._request(params)
+            metrics.REGISTRY.inc("search_responses_total", status=response.status_code)
+            data = response.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            metrics.REGISTRY.inc("search_errors_total")
+            logging.error("Custom search for {} failed: {}".format(query, e))
+            return None
+        if "error" in data:
+            # 429s are retried by the pool, one that is still there afterwards means the quota is gone as well
+            if data["error"].get("code") in (403, 429) or response.status_code == 429:
+                logging.error("Over our search quota for today.")
+                self.quota.mark_exhausted()
+            else:
+                logging.error("Custom search for {} failed: {}".format(query, data["error"]))
+            return None
+        if self.cache is not None:
+            self.cache.set("customsearch", params, data)
+        return data.get("items", [])
+
+
+    """
+    Fetch every query in QUERIES. Returns the items for each query that was searched, in order, as (query, items)
+    pairs, and the queries that still have to be searched once the quota allows it.
+    """
+    def fetch_all(self, queries):
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = list(executor.map(self.fetch, queries))
+        searched = [(query, items) for query, items in zip(queries, results) if items is not None]
+        remaining = [query for query, items in zip(queries, results) if items is None]
+        return searched, remaining
+
 
 """
 Receives relative_search_volumes and initial search query as inputs.
 Our function then makes a search using Google's API, parses through the first ten sites in the results for each search and writes the appropriate attributes to a csv file in OUTPUT/SEARCH.
+With OUTPUT_STORE set, the rows are appended to its search_results dataset instead of a csv file.
+Without a FETCHER, one is made that counts the daily quota in QUOTA_PATH.
+Returns the terms that could not be searched (for example because the daily quota ran out).
 """
-def main(relative_search_volumes, initial_search_query):
+@metrics.timed("stage_seconds", stage="search")
+def main(relative_search_volumes, initial_search_query, search_url=SEARCH_URL, output_store=None, fetcher=None, quota_path=QUOTA_FILE):
     code = "US"
-    head, tail = os.path.split(dirname(__file__))
-    params = {
-        'url' : 'www.googleapis.com/customsearch/v1',
-        'cx' : "007577961584064119408%3A0r-ks0pzwfw",
-        'key' : "", #TODO: add developer key here
-    }
+    fetcher = fetcher or SiteSearchFetcher(search_url=search_url, quota_path=quota_path)
+    volumes = dict((list(q.keys())[0], list(q.values())[0]) for q in relative_search_volumes)
+    searched, remaining = fetcher.fetch_all(list(volumes))
+    if remaining:
+        logging.warning("{} terms were not searched: {}".format(len(remaining), remaining))
+
+    rows = result_rows(initial_search_query, searched, volumes)
+    write_results(rows, initial_search_query, code, output_store)
+    return remaining
+
+
+"""
+One row per result link for every (query, items) pair in SEARCHED.
+Site probability of a row is the relative search volume of its query (from VOLUMES) times the probability of its position.
+"""
+def result_rows(initial_search_query, searched, volumes):
+    rows = []
+    for query, items in searched:
+        for index, item in enumerate(items, 1):
+            if "link" not in item or "displayLink" not in item:
+                continue
+            rows.append({
+                "initial_search_query": initial_search_query,
+                "query": query,
+                "position": index,
+                "link": item["link"],
+                "displayLink": item["displayLink"],
+            })
+    # Site probability of every row at once
+    positions = np.array([row["position"] for row in rows], dtype=int)
+    query_volumes = np.array([volumes[row["query"]] for row in rows], dtype=float)
+    for row, probability in zip(rows, query_volumes * get_probabilities(positions)):
+        row["site_probability"] = float(probability)
+    return rows
+
+
+"""
+Write result ROWS to the search_results dataset of OUTPUT_STORE, or to a csv file in OUTPUT/SEARCH/CODE without one
+"""
+def write_results(rows, initial_search_query, code, output_store=None):
+    if output_store is not None:
+        output_store.append("search_results", initial_search_query, code, [
+            dict((field, row[field]) for field in ("query", "position", "link", "displayLink", "site_probability"))
+            for row in rows
+        ])
+        return
+
     output_dir = os.getcwd() + "/output/search/" + code
     simulate_keywords.Simulation.mkdir_p(output_dir)
     name = output_dir + "/" + datetime.datetime.now().strftime('%Y-%m-%d-%H:%M') + ".csv"
-
     with open(name, "w") as csvfile:
         field_names = ["initial_search_query", "query", "position", "link", "displayLink", "site_probability"]
         writer = csv.DictWriter(csvfile, fieldnames=field_names)
         writer.writeheader()
-        for q in relative_search_volumes:
-            params['q'] = list(q.keys())[0]
+        for row in rows:
             try:
-                text = u'https://{url}?q={q}&cx={cx}&key={key}'.format(**params)
-                reponse = requests.get(text.encode("utf8"))
-                data = json.loads(reponse.text)
-            except requests.exceptions.SSLError as e:
+                writer.writerow(row)
+            except UnicodeEncodeError as e:
                 print(e)
-                pass
-
-            try:
-                if data["error"]["code"] == 403:
-                    #do some error correcting
-                    raise Exception("Over our search quota for today.")
-            except:
-                index = 1
-                try:
-                    for item in data["items"]:
-                        probability = return_site_probability(q, str(index))
-                        writer.writerow({
-                            "initial_search_query": initial_search_query,
-                            "query": list(q.keys())[0],
-                            "position": str(index),
-                            "link": item["link"],
-                            "displayLink": item["displayLink"],
-                            "site_probability": probability
-                        })
-                        index += 1
-                    index = 1
-                except UnicodeEncodeError as e:
-                    print(e)
-                    continue
-                except KeyError:
-                    continue
+                continue
 
 
 """
@@ -71,28 +294,22 @@ def return_site_probability(relative_search_volume, position ):
     return probability * get_probability(position)
 
 
+"""
+Site probabilities for an array of result POSITIONS (1 based), positions past the table get the last entry
+"""
+def get_probabilities(positions):
+    index = np.where(positions >= 1, np.minimum(positions, len(SITE_PROBABILITIES)) - 1, len(SITE_PROBABILITIES) - 1)
+    return SITE_PROBABILITIES[index]
+
+
 """
 Site probabilities are determined by Chitika study
 For reference, please see methodology paper
 """
 def get_probability(position):
-    if position == "1":
-        return 0.35
-    elif position == "2":
-        return 0.20
-    elif position == "3":
-        return 0.15
-    elif position == "4":
-        return 0.08
-    elif position == "5":
-        return 0.07
-    elif position == "6":
-        return 0.05
-    elif position == "7":
-        return 0.04
-    elif position == "8":
-        return 0.03
-    elif position == "9":
-        return 0.02
-    else:
-        return 0.01
+    try:
+        position = int(position)
+    except (TypeError, ValueError):
+        # Anything that is not a position gets the lowest probability
+        return float(SITE_PROBABILITIES[-1])
+    return float(get_probabilities(np.array([position]))[0])
@@ -5,27 +5,57 @@ import datetime
 import csv
 import errno
 import time
+import numpy as np
 from google_client import GoogleClient
+from keyword_expansion import KeywordExpander
+from keyword_graph import KeywordGraph
+from query_index import QueryIndex
+import metrics
+import log_setup
 
 
 class Simulation(object):
-    LOG_FILE = "log/simulation.log" # Logging file output
+    LOG_FILE = "log/simulation.jsonl" # Logging file output, one JSON record per line (see log_setup.py)
     TRENDS_SERVER = "https://www.googleapis.com"
     LOCATIONS_FILE = "simulation_locations.csv" # List of locations to run the simulation for
     TRENDS_VERSION = "v1beta"
+    CACHE_FILE = "cache/responses.sqlite" # Default location of the on-disk API response cache
+    JOURNAL_FILE = "journal/simulation.jsonl" # Default journal of completed work, used to resume runs
+    TIMELINE_OVERLAP_DAYS = 28 # Days an extended timeline window refetches to rescale the new dates
     K = 1
+    MAX_DEPTH = 3 # Number of query levels generate_keywords builds, including the top queries
+    EXPANSION_WORKERS = 8 # Concurrent getTopQueries calls while expanding the query tree
 
-    def __init__(self, initial_search_term, geoLocation, startDateTrends, endDateTrends, startDateTimelines, endDateTimelines):
+    def __init__(self, initial_search_term, geoLocation, startDateTrends, endDateTrends, startDateTimelines, endDateTimelines, cache=None, google_client=None, journal=None, incremental=False, query_index=None):
         self.initial_search_term = initial_search_term
         self.geoLocation = geoLocation
         self.startDateTrends = startDateTrends
         self.endDateTrends = endDateTrends
         self.startDateTimelines = startDateTimelines
         self.endDateTimelines = endDateTimelines
-        self.google_client = GoogleClient(Simulation.TRENDS_SERVER, Simulation.TRENDS_VERSION)
+        # Simulations for different locations can share one client (and its cache and rate limiter)
+        self.google_client = google_client or GoogleClient(Simulation.TRENDS_SERVER, Simulation.TRENDS_VERSION, cache=cache)
+        # With a journal, finished work is read back instead of fetched again (see journal.py)
+        self.journal = journal
+        # Extend timelines from an earlier, shorter window in the journal instead of fetching the whole range
+        self.incremental = incremental
+        # Share one index between simulations so equivalent queries are only fetched once per run
+        self.query_index = query_index or QueryIndex()
         self.topics = []
-        self.initial_queries = []
+        # Every query found for the seed term, see keyword_graph.py
+        self.keywords = KeywordGraph()
         self.relative_search_volumes = []
+        # Calls made and coverage given up by best first expansion, None for breadth first
+        self.expansion_report = None
+
+
+    """
+    The keyword graph as nested dicts, one per top query with its follow up terms, for code that walks the tree.
+    Built on every access; use self.keywords directly where possible.
+    """
+    @property
+    def initial_queries(self):
+        return self.keywords.as_tree()
 
     
     """
@@ -57,15 +87,15 @@ class Simulation(object):
             field_names = ["initial search term", "startDate", "endDate", "query", "value", "level"]
             writer = csv.DictWriter(csvfile, fieldnames=field_names)
             writer.writeheader()
-            for item in self.initial_queries: 
+            for node in self.keywords.nodes(level=1): 
                 try: 
                     writer.writerow({
                         "initial search term": self.initial_search_term,
                         "startDate": self.startDateTrends,
                         "endDate": self.endDateTrends,
-                        "query": item['query'], 
-                        "value": item['value'], 
-                        "level": item['level']
+                        "query": self.keywords.query(node), 
+                        "value": self.keywords.value(node), 
+                        "level": self.keywords.level(node)
                     })
                 except UnicodeEncodeError as e: 
                     logging.error("Unicode Error: {}".format(e.object[e.start:e.end]))
@@ -91,25 +121,94 @@ class Simulation(object):
                     continue
     
     
+    """
+    Append the queries and relative search volumes of this simulation to OUTPUT_STORE (see output_store.py)
+    """
+    @metrics.timed("stage_seconds", stage="write_output")
+    def write_output(self, output_store):
+        seed, geo = self.initial_search_term, self.geoLocation['code']
+        output_store.append("top_queries", seed, geo, [{
+            "initial_search_term": seed,
+            "start_date": self.startDateTrends,
+            "end_date": self.endDateTrends,
+            "query": query,
+            "value": value,
+            "level": level,
+            "parent": parent,
+        } for query, value, level, parent in self.keywords.rows()])
+        output_store.append("relative_search_volume", seed, geo, [{
+            "term": list(item.keys())[0],
+            "relative_search_volume": list(item.values())[0],
+            "start_date": self.startDateTimelines,
+            "end_date": self.endDateTimelines,
+        } for item in self.relative_search_volumes])
+
+
+    @staticmethod
+    def _as_list(result):
+        return None if result is None else list(result)
+
+
+    """
+    Run FETCH unless the journal says this unit of work already finished, and journal its result.
+    FETCH returns None when it failed, which is not journaled.
+    """
+    def _journaled(self, method, term, startDate, endDate, fetch):
+        if self.journal is None:
+            return fetch()
+        geo = self.geoLocation['code']
+        result = self.journal.get(method, term, geo, startDate, endDate)
+        if result is not None:
+            return result
+        result = fetch()
+        # Offline results are only what the cache happened to have, so they do not count as done
+        if result is not None and not self.google_client.offline:
+            self.journal.record(method, term, geo, startDate, endDate, result)
+        return result
+
+
+    """
+    Top queries (and their values) for QUERY in this simulation's location and window.
+    Equivalent queries (see query_index.py) share one result.
+    """
+    def find_queries(self, query):
+        result = self._find_queries(query)
+        # A failed request expands to nothing this time, and is neither journaled nor kept in the index
+        return ([], []) if result is None else result
+
+
+    def _find_queries(self, query):
+        return self.query_index.get_or_fetch(
+            query, self.geoLocation['code'], self.startDateTrends, self.endDateTrends,
+            lambda: self._journaled("getTopQueries", query, self.startDateTrends, self.endDateTrends, lambda: Simulation._as_list(
+                self.google_client.find_queries(query, self.geoLocation['code'], self.startDateTrends, self.endDateTrends)
+            ))
+        )
+
+
     """
     Sets the Topics for a given simulation.
     """
     def get_topics(self):
-        self.topics = self.google_client.find_topics(
-            self.initial_search_term, self.geoLocation['code'], self.startDateTrends, self.endDateTrends
-        )
+        self.topics = self._journaled("getTopTopics", self.initial_search_term, self.startDateTrends, self.endDateTrends, lambda: Simulation._as_list(
+            self.google_client.find_topics(
+                self.initial_search_term, self.geoLocation['code'], self.startDateTrends, self.endDateTrends
+            )
+        )) or []
 
     
     """
     Obtains the top queries for a given simulation
     """
     def get_queries(self):
-        queries, values = self.google_client.find_queries(
-            self.initial_search_term, self.geoLocation['code'], self.startDateTrends, self.endDateTrends
-        )
+        result = self._find_queries(self.initial_search_term)
+        if result is None:
+            # Without the seed's own top queries there is nothing to simulate, the location has to run again
+            raise ValueError("Could not get the top queries for {}".format(self.initial_search_term))
+        queries, values = result
         for query, value in zip(queries, values): 
-            item = {"query": query, "value": value, "level": 1, "follow_up_terms": []}
-            self.initial_queries.append(item)
+            self.keywords.add(query, value, 1)
+            metrics.REGISTRY.inc("expansion_items_total", level=1)
 
 
     """
@@ -118,49 +217,106 @@ class Simulation(object):
     Get the developer API from a team member and assign as an env variable. 
     There are a few places to look out for exceptions in this function. 
     If the keyword_number argument is set to an invalid number, a ValueError is raised in our get_case_words function. 
+    With BEST_FIRST, queries are expanded most relevant first, queries with a value below MIN_VALUE are not expanded
+    and at most EXPANSION_BUDGET queries are expanded, or as many as CALL_BUDGET (a rate_limiter.CallBudget) pays Google for;
+    see KeywordExpander.expand_best_first and self.expansion_report.
     """
-    def generate_keywords(self):
-        logging.info(self.geoLocation)
-        logging.info("Starting simulation with Trends for area: " + self.geoLocation['description'])
+    @metrics.timed("stage_seconds", stage="generate_keywords")
+    def generate_keywords(self, max_depth=None, max_workers=None, best_first=False, min_value=0, expansion_budget=None, call_budget=None):
+        log_setup.log_event("simulation.started", "Starting simulation with Trends for area: " + self.geoLocation['description'],
+            seed=self.initial_search_term, geo=self.geoLocation['code'])
         try:
             self.get_topics()
             self.get_queries()
         except ValueError as e:
             logging.error("Could not evaluate seed set")
             raise e
- 
-        queries_no_duplicates = set([x['query'] for x in self.initial_queries])
-    
-        for item in self.initial_queries:
-            follow_up_queries, follow_up_values = self.google_client.find_queries(
-                item['query'], self.geoLocation, self.startDateTrends, self.endDateTrends
+        self.expand_queries(max_depth, max_workers, best_first, min_value, expansion_budget, call_budget)
+
+
+    """
+    Expand the top queries into follow up terms, up to MAX_DEPTH levels
+    """
+    def expand_queries(self, max_depth=None, max_workers=None, best_first=False, min_value=0, expansion_budget=None, call_budget=None):
+        # Queries are deduplicated on their canonical form, so "food bank near me" and "food banks near me" count once
+        queries_no_duplicates = set(self.query_index.canonical(query) for query in self.keywords.queries())
+
+        # Level 1 comes from get_queries, every further level is fetched concurrently by the expander
+        # To look beyond three levels, pass a larger max_depth
+        expander = KeywordExpander(
+            self.find_queries,
+            max_depth=max_depth or Simulation.MAX_DEPTH,
+            max_workers=max_workers or Simulation.EXPANSION_WORKERS,
+            canonical=self.query_index.canonical
+        )
+        if best_first:
+            self.expansion_report = expander.expand_best_first(
+                self.keywords, self.keywords.nodes(level=1), queries_no_duplicates,
+                min_value=min_value, expansion_budget=expansion_budget, call_budget=call_budget
             )
-            for query, value in zip(follow_up_queries, follow_up_values): 
-                if query not in queries_no_duplicates: 
-                    logging.info("Adding {} to our seed set.".format(query))
-                    new_item = {"query": query, "value": value, "level": 2, "follow_up_terms": []}
-                    item['follow_up_terms'].append(new_item)
-                    queries_no_duplicates.add(query)
-            # Then, we look at the next level of queries
-            # To look beyond three levels, modify this function
-            for second_level_item in item['follow_up_terms']:
-                follow_up_queries, follow_up_values = self.google_client.find_queries(
-                    second_level_item['query'], self.geoLocation, self.startDateTrends, self.endDateTrends
-                )
-                for query, value in zip(follow_up_queries, follow_up_values): 
-                    if query not in queries_no_duplicates: 
-                        logging.info("Adding {} to our seed set.".format(query))
-                        new_item = {"query": query, "value": value, "level": 3, "follow_up_terms": []}
-                        second_level_item['follow_up_terms'].append(new_item)
-                        queries_no_duplicates.add(query)
+            log_setup.log_event("expansion.report", seed=self.initial_search_term, geo=self.geoLocation['code'], **self.expansion_report)
+        else:
+            expander.expand(self.keywords, self.keywords.nodes(level=1), queries_no_duplicates)
                         
     
+    """
+    Terms x time matrix for TERMS over the timelines window as (dates, matrix), going through the journal.
+    In incremental mode a journaled window with the same start and an earlier end is extended: only the dates after
+    it (plus TIMELINE_OVERLAP_DAYS to rescale on) are fetched and stitched on.
+    FETCH(startDate, endDate) makes the request, get_timelines_sharded by default.
+    """
+    def _get_timelines(self, terms, fetch=None):
+        fetch = fetch or (lambda startDate, endDate: self.google_client.get_timelines_sharded(terms, self.geoLocation, startDate, endDate))
+        geo = self.geoLocation['code']
+        startDate, endDate = self.startDateTimelines, self.endDateTimelines
+        earlier = None
+        if self.journal is not None:
+            done = self.journal.get("getTimelinesMatrix", terms, geo, startDate, endDate)
+            if done is not None:
+                return done['dates'], np.array(done['matrix'])
+            if self.incremental:
+                earlier = self.journal.find_earlier_window("getTimelinesMatrix", terms, geo, startDate, endDate)
+
+        if earlier is not None:
+            previous_end, previous = earlier
+            overlap_start = datetime.date.fromisoformat(previous_end) - datetime.timedelta(days=Simulation.TIMELINE_OVERLAP_DAYS)
+            tail_start = max(startDate, overlap_start.isoformat())
+            logging.info("Extending timelines for {} from {} instead of {}".format(geo, tail_start, startDate))
+            tail = fetch(tail_start, endDate)
+            timelines = None if tail is None else GoogleClient.stitch_timelines(
+                (previous['dates'], np.array(previous['matrix'])), tail
+            )
+        else:
+            timelines = fetch(startDate, endDate)
+
+        if self.journal is not None and timelines is not None and not self.google_client.offline:
+            dates, matrix = timelines
+            self.journal.record("getTimelinesMatrix", terms, geo, startDate, endDate, {
+                "dates": dates, "matrix": matrix.tolist()
+            })
+        return timelines
+
+
+    """
+    One anchored batch of TERMS over the timelines window, going through the journal like _get_timelines;
+    see GoogleClient.get_anchored_batch for REFERENCE
+    """
+    def get_timelines_batch(self, terms, reference=None):
+        return self._get_timelines(terms, lambda startDate, endDate: self.google_client.get_anchored_batch(
+            terms, self.geoLocation, startDate, endDate, reference
+        ))
+
+
+    @metrics.timed("stage_seconds", stage="get_relative_search_volumes")
     def get_relative_search_volumes(self): 
         logging.info("Starting simulation with health trends")
         # You could also override terms to use your masterlist so that you are working with the same list of terms for all locs
-        terms = [query['query'] for query in self.initial_queries if query['level'] == 1]
-        relative_search_volumes = self.google_client.get_timelines_for_health(
-            terms, self.geoLocation, self.startDateTimelines, self.endDateTimelines
-        )
+        terms = self.keywords.queries(level=1)
+        if self.journal is None:
+            relative_search_volumes = self.google_client.get_timelines_for_health(
+                terms, self.geoLocation, self.startDateTimelines, self.endDateTimelines
+            )
+        else:
+            timelines = self._get_timelines(terms)
+            relative_search_volumes = [] if timelines is None else self.google_client._average(terms, timelines[1])
         self.relative_search_volumes = relative_search_volumes
-    
\ No newline at end of file
@@ -0,0 +1,59 @@
+import threading
+
+
+class _Call(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+"""
+Coalesces concurrent calls with the same key.
+The first caller for a key runs the function, callers that arrive while it is in flight wait for it and get
+the same result (or exception). Nothing is kept once the call finishes; that is what the response cache is for.
+"""
+class SingleFlight(object):
+
+    def __init__(self):
+        self.calls = 0
+        self.shared = 0
+        self._in_flight = dict()
+        self._lock = threading.Lock()
+
+
+    """
+    Run FUNCTION for KEY unless a call for KEY is already in flight, returns (result, shared)
+    where SHARED is True when the result came from another caller's call
+    """
+    def do(self, key, function):
+        with self._lock:
+            call = self._in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = self._in_flight[key] = _Call()
+                self.calls += 1
+            else:
+                self.shared += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = function()
+            return call.result, False
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            call.done.set()
+
+
+    def stats(self):
+        with self._lock:
+            return {"calls": self.calls, "shared": self.shared, "in_flight": len(self._in_flight)}
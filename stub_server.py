@@ -0,0 +1,327 @@
+import sys
+import json
+import time
+import random
+import zlib
+import logging
+import argparse
+import datetime
+import threading
+import http.server
+import urllib.error
+import urllib.request
+from urllib.parse import urlparse, parse_qsl, urlencode
+
+
+# Vocabulary the synthetic top queries are drawn from. It is small on purpose so that
+# expansion runs into the same queries again, like it does against the real service.
+WORDS = [
+    "food", "bank", "banks", "pantry", "near", "me", "free", "open", "today", "hours", "donate",
+    "volunteer", "snap", "wic", "benefits", "meals", "kids", "school", "lunch", "church", "county",
+    "emergency", "groceries", "delivery", "apply", "online", "eligibility", "formula", "baby", "diapers",
+]
+
+TRENDS_METHODS = {
+    "topQueries": ("getTopQueries", ["term", "restrictions.geo", "restrictions.startDate", "restrictions.endDate"]),
+    "topTopics": ("getTopTopics", ["term", "restrictions.geo", "restrictions.startDate", "restrictions.endDate"]),
+    "timelinesForHealth": ("getTimelinesForHealth", [
+        "terms", "time.startDate", "time.endDate",
+        "geoRestriction.country", "geoRestriction.region", "geoRestriction.dma",
+    ]),
+}
+
+
+"""
+Discovery document describing the parts of the trends api we use, pointing at ROOT_URL
+"""
+def discovery_document(root_url, version="v1beta"):
+    methods = dict()
+    for path, (name, parameters) in TRENDS_METHODS.items():
+        methods[name] = {
+            "id": "trends." + name,
+            "path": path,
+            "httpMethod": "GET",
+            "parameters": dict(
+                (parameter, {"type": "string", "location": "query", "repeated": parameter == "terms"})
+                for parameter in parameters
+            ),
+            "response": {"$ref": "Response"},
+        }
+    return {
+        "kind": "discovery#restDescription",
+        "discoveryVersion": "v1",
+        "id": "trends:" + version,
+        "name": "trends",
+        "version": version,
+        "protocol": "rest",
+        "rootUrl": root_url + "/",
+        "servicePath": "trends/" + version + "/",
+        "baseUrl": root_url + "/trends/" + version + "/",
+        "batchPath": "batch",
+        "parameters": {"key": {"type": "string", "location": "query"}},
+        "schemas": {"Response": {"id": "Response", "type": "object"}},
+        "methods": methods,
+    }
+
+
+def _seed(*parts):
+    return zlib.crc32("|".join(parts).encode("utf8"))
+
+
+def top_queries(term, geo):
+    rng = random.Random(_seed(term, geo))
+    items = []
+    for rank in range(rng.randint(0, 8)):
+        title = " ".join(rng.sample(WORDS, rng.randint(2, 4)))
+        items.append({"title": title, "value": max(1, 100 - rank * rng.randint(5, 20))})
+    return {"item": items} if items else {}
+
+
+def top_topics(term, geo):
+    return {"item": [{"mid": "/m/{:07x}".format(_seed(term) & 0xfffffff), "title": term, "value": 100}]}
+
+
+"""
+Weekly points between START and END. Like the real service, values are scaled so the largest point
+of the request is 100, which is why batches are not comparable without an anchor term.
+"""
+def timelines_for_health(terms, geo, start, end):
+    start_date = datetime.date.fromisoformat(start[:10] if len(start) > 7 else start + "-01")
+    end_date = datetime.date.fromisoformat(end[:10] if len(end) > 7 else end + "-28")
+    # Like Google, weekly points fall on Sundays, so overlapping windows share their dates
+    start_date += datetime.timedelta(days=(6 - start_date.weekday()) % 7)
+    dates = []
+    while start_date <= end_date:
+        dates.append(start_date)
+        start_date += datetime.timedelta(days=7)
+    raw = dict()
+    for term in terms:
+        rng = random.Random(_seed(term, geo))
+        level = rng.uniform(1, 1000)
+        # Seed by date as well so overlapping windows agree on the shape of the series
+        raw[term] = [level * random.Random(_seed(term, geo, date.isoformat())).uniform(0.5, 1.5) for date in dates]
+    peak = max([max(values) for values in raw.values() if values] or [1])
+    return {"lines": [
+        {"term": term, "points": [
+            {"date": date.strftime("%b %d %Y"), "value": round(value * 100 / peak, 4)} for date, value in zip(dates, raw[term])
+        ]} for term in terms
+    ]}
+
+
+def custom_search(query):
+    rng = random.Random(_seed(query))
+    sites = ["site{}.example.org".format(rng.randint(0, 50)) for _ in range(10)]
+    return {"items": [
+        {"link": "https://{}/{}".format(site, index), "displayLink": site} for index, site in enumerate(sites)
+    ]}
+
+
+"""
+Local stand-in for the trends and custom search apis.
+Every response is delayed by LATENCY seconds (plus up to JITTER), and a fraction ERROR_RATE of data
+requests fail with one of ERROR_CODES. Responses recorded in REPLAY_FILE are served instead of synthetic
+ones when the request matches. With UPSTREAM set, requests are forwarded there and recorded to RECORD_FILE.
+"""
+class StubServer(object):
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, jitter=0.0, error_rate=0.0, error_codes=(429, 503),
+                 retry_after=None, replay_file=None, upstream=None, record_file=None, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_codes = list(error_codes)
+        self.retry_after = retry_after
+        self.upstream = upstream
+        self.record_file = record_file
+        self.replay = StubServer.load_replay(replay_file) if replay_file else dict()
+        self.requests = dict()
+        self.errors = dict()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._httpd = http.server.ThreadingHTTPServer((host, port), StubServer._handler(self))
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+
+    """
+    Key a request by its path and parameters, leaving out the api key
+    """
+    @staticmethod
+    def request_key(path, query):
+        params = sorted((name, value) for name, value in parse_qsl(query, keep_blank_values=True) if name not in ("key", "alt"))
+        return path + "?" + urlencode(params)
+
+
+    @staticmethod
+    def load_replay(replay_file):
+        replay = dict()
+        with open(replay_file, "r") as recording:
+            for line in recording:
+                if line.strip():
+                    entry = json.loads(line)
+                    replay[entry["key"]] = (entry["status"], entry["body"])
+        return replay
+
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+
+    def serve_forever(self):
+        try:
+            self._httpd.serve_forever()
+        finally:
+            self._httpd.server_close()
+
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+    def __enter__(self):
+        return self.start()
+
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+    def stats(self):
+        with self._lock:
+            return {"requests": dict(self.requests), "errors": dict(self.errors)}
+
+
+    def _count(self, counter, endpoint):
+        with self._lock:
+            counter[endpoint] = counter.get(endpoint, 0) + 1
+
+
+    def _should_fail(self):
+        with self._lock:
+            if self.error_rate and self._random.random() < self.error_rate:
+                return self._random.choice(self.error_codes)
+        return None
+
+
+    def _synthesize(self, endpoint, params):
+        single = dict(params)
+        geo = single.get("restrictions.geo") or single.get("geoRestriction.country") or \
+            single.get("geoRestriction.region") or single.get("geoRestriction.dma") or ""
+        if endpoint == "topQueries":
+            return top_queries(single.get("term", ""), geo)
+        if endpoint == "topTopics":
+            return top_topics(single.get("term", ""), geo)
+        if endpoint == "timelinesForHealth":
+            terms = [value for name, value in params if name == "terms"]
+            return timelines_for_health(terms, geo, single["time.startDate"], single["time.endDate"])
+        return custom_search(single.get("q", ""))
+
+
+    def _forward(self, path, key):
+        request = urllib.request.Request(self.upstream + path)
+        try:
+            with urllib.request.urlopen(request) as response:
+                status, body = response.status, json.loads(response.read().decode("utf8"))
+        except urllib.error.HTTPError as e:
+            status, body = e.code, json.loads(e.read().decode("utf8") or "{}")
+        if self.record_file:
+            with self._lock:
+                with open(self.record_file, "a") as recording:
+                    recording.write(json.dumps({"key": key, "status": status, "body": body}) + "\n")
+        return status, body
+
+
+    """
+    Status and body for one GET request
+    """
+    def respond(self, raw_path):
+        parsed = urlparse(raw_path)
+        path = parsed.path.rstrip("/")
+        if path.startswith("/discovery/"):
+            version = path.split("/")[5]
+            return "discovery", 200, discovery_document(self.url, version), None
+
+        endpoint = path.split("/")[-1]
+        if endpoint not in TRENDS_METHODS and endpoint != "v1":
+            return endpoint, 404, {"error": {"code": 404, "message": "Unknown endpoint " + path}}, None
+        if endpoint == "v1":
+            endpoint = "customsearch"
+        self._count(self.requests, endpoint)
+        delay = self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay:
+            time.sleep(delay)
+
+        code = self._should_fail()
+        if code is not None:
+            self._count(self.errors, endpoint)
+            retry_after = self.retry_after if code == 429 else None
+            return endpoint, code, {"error": {"code": code, "message": "Injected error"}}, retry_after
+
+        key = StubServer.request_key(path, parsed.query)
+        if key in self.replay:
+            status, body = self.replay[key]
+            return endpoint, status, body, None
+        if self.upstream:
+            status, body = self._forward(raw_path, key)
+            return endpoint, status, body, None
+        return endpoint, 200, self._synthesize(endpoint, parse_qsl(parsed.query, keep_blank_values=True)), None
+
+
+    @staticmethod
+    def _handler(stub):
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                endpoint, status, body, retry_after = stub.respond(self.path)
+                payload = json.dumps(body).encode("utf8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json; charset=UTF-8")
+                self.send_header("Content-Length", str(len(payload)))
+                if retry_after is not None:
+                    self.send_header("Retry-After", str(retry_after))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                logging.debug("stub server: " + format % args)
+
+        return Handler
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve a local stand-in for the trends and custom search apis")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds added to every data request")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with an error")
+    parser.add_argument("--error-codes", type=int, nargs="+", default=[429, 503])
+    parser.add_argument("--retry-after", type=float, default=None, help="Retry-After seconds sent with injected 429s")
+    parser.add_argument("--replay", default=None, help="jsonl file of recorded responses to serve")
+    parser.add_argument("--upstream", default=None, help="forward requests here, e.g. https://www.googleapis.com")
+    parser.add_argument("--record", default=None, help="append forwarded responses to this jsonl file")
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+
+    stub = StubServer(
+        port=args.port, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+        error_codes=args.error_codes, retry_after=args.retry_after, replay_file=args.replay,
+        upstream=args.upstream, record_file=args.record
+    )
+    print("Serving on {}".format(stub.url))
+    try:
+        stub.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+import os
+import sys
+import datetime
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# simulate_keywords first, google_client imports it back
+import simulate_keywords
+from google_client import GoogleClient
+
+
+"""
+Stand-in for getTimelinesForHealth. Every term has a true daily volume from VOLUME(term, day) and, like Google,
+each request is scaled on its own so its loudest point is 100. MISSING(term, request_terms) drops a term's line
+from a response, the way Google leaves out terms below its privacy threshold. Requests are kept in REQUESTS.
+"""
+class FakeTimelines(object):
+
+    def __init__(self, volume, missing=None):
+        self.volume = volume
+        self.missing = missing or (lambda term, request_terms: False)
+        self.requests = []
+
+
+    @staticmethod
+    def days(startDate, endDate):
+        start, end = datetime.date.fromisoformat(startDate), datetime.date.fromisoformat(endDate)
+        return [(start + datetime.timedelta(days=offset)).isoformat() for offset in range((end - start).days + 1)]
+
+
+    def true_matrix(self, terms, startDate, endDate):
+        return np.array([[self.volume(term, day) for day in FakeTimelines.days(startDate, endDate)] for term in terms], dtype=np.float64)
+
+
+    def __call__(self, loc_type, geoLocation, request_terms, startDate, endDate):
+        self.requests.append((list(request_terms), startDate, endDate))
+        days = FakeTimelines.days(startDate, endDate)
+        matrix = self.true_matrix(request_terms, startDate, endDate)
+        matrix = matrix * (100.0 / matrix.max())
+        return [
+            {"term": term, "points": [{"date": day, "value": value} for day, value in zip(days, row)]}
+            for term, row in zip(request_terms, matrix) if not self.missing(term, request_terms)
+        ]
+
+
+"""
+Share of the total volume of every row of MATRIX, what get_timelines_for_health reports
+"""
+def shares(matrix):
+    totals = np.asarray(matrix).sum(axis=1)
+    return totals / totals.sum()
+
+
+@pytest.fixture
+def client():
+    return GoogleClient(simulate_keywords.Simulation.TRENDS_SERVER, simulate_keywords.Simulation.TRENDS_VERSION, timeline_workers=2)
+
+
+@pytest.fixture
+def geo():
+    return {"code": "US", "description": "United States"}
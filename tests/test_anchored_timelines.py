@@ -0,0 +1,58 @@
+import math
+import datetime
+import numpy as np
+
+from conftest import FakeTimelines, shares
+from google_client import GoogleClient
+
+
+def volume(term, day):
+    index = int(term[1:])
+    return (1 + index % 13) * (1.5 + math.sin(datetime.date.fromisoformat(day).toordinal() / 7.0 + index))
+
+
+TERMS = ["t{}".format(index) for index in range(70)]
+
+
+def test_rescale_on_anchor_matches_the_reference():
+    batch = np.array([[1.0, 3.0], [2.0, 2.0]])
+    GoogleClient.rescale_on_anchor(batch, 8.0, "anchor")
+    assert batch[0].sum() == 8.0
+    assert batch[1].tolist() == [4.0, 4.0]
+
+
+def test_rescale_on_anchor_without_volume_leaves_the_batch():
+    batch = np.array([[0.0, 0.0], [2.0, 2.0]])
+    GoogleClient.rescale_on_anchor(batch, 8.0, "anchor")
+    assert batch.tolist() == [[0.0, 0.0], [2.0, 2.0]]
+
+
+def test_timeline_batches_carry_the_anchor(client):
+    batches = client._timeline_batches(TERMS, "t3")
+    assert batches[0] == TERMS[:GoogleClient.TIMELINE_BATCH_SIZE]
+    assert all(len(batch) <= GoogleClient.TIMELINE_BATCH_SIZE for batch in batches)
+    assert all(batch[0] == "t3" for batch in batches[1:])
+    assert [term for batch in batches[1:] for term in batch[1:]] == TERMS[GoogleClient.TIMELINE_BATCH_SIZE:]
+
+
+def test_batched_shares_match_the_true_shares(client, geo, monkeypatch):
+    fake = FakeTimelines(volume)
+    monkeypatch.setattr(client, "_get_timelines_batch", fake)
+    dates, matrix = client.get_timelines_matrix(TERMS, geo, "2020-01-01", "2020-03-31")
+    assert len(fake.requests) == 3
+    # The anchor is the loudest term of the first batch
+    loudest = max(TERMS[:GoogleClient.TIMELINE_BATCH_SIZE], key=lambda term: fake.true_matrix([term], "2020-01-01", "2020-03-31").sum())
+    assert all(request_terms[0] == loudest for request_terms, _, _ in fake.requests[1:])
+    np.testing.assert_allclose(shares(matrix), shares(fake.true_matrix(TERMS, "2020-01-01", "2020-03-31")))
+
+
+def test_anchor_without_volume_in_a_batch_is_retried_on_the_next_loudest(client, geo, monkeypatch):
+    fake = FakeTimelines(volume)
+    loudest = max(TERMS[:GoogleClient.TIMELINE_BATCH_SIZE], key=lambda term: fake.true_matrix([term], "2020-01-01", "2020-03-31").sum())
+    # The loudest term drops out of every later batch, as if below the privacy threshold there
+    fake.missing = lambda term, request_terms: term == loudest and "t60" in request_terms
+    monkeypatch.setattr(client, "_get_timelines_batch", fake)
+    dates, matrix = client.get_timelines_matrix(TERMS, geo, "2020-01-01", "2020-03-31")
+    retried = [request_terms for request_terms, _, _ in fake.requests if request_terms[0] not in (loudest, TERMS[0])]
+    assert len(retried) == 1 and "t60" in retried[0]
+    np.testing.assert_allclose(shares(matrix), shares(fake.true_matrix(TERMS, "2020-01-01", "2020-03-31")))
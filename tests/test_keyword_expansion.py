@@ -0,0 +1,45 @@
+from keyword_expansion import KeywordExpander
+from keyword_graph import KeywordGraph
+from rate_limiter import CallBudget
+
+
+"""
+getTopQueries stand-in: every query has three follow ups, queries in CACHED are answered without a request
+"""
+def find_queries(cached=()):
+    def find(query):
+        budget = CallBudget.current()
+        if budget is not None and query not in cached:
+            budget.spend()
+        return [query + " " + suffix for suffix in "abc"], [90, 60, 30]
+    return find
+
+
+def expand(find, call_budget, roots=("x", "y")):
+    graph = KeywordGraph()
+    nodes = [graph.add(root, 100, 1) for root in roots]
+    expander = KeywordExpander(find, max_depth=4, max_workers=4)
+    report = expander.expand_best_first(graph, nodes, set(roots), call_budget=call_budget)
+    return graph, report
+
+
+def test_call_budget_stops_expansion():
+    budget = CallBudget(5)
+    graph, report = expand(find_queries(), budget)
+    assert budget.calls == 5
+    assert report["expansions"] == 5
+    assert report["unexpanded"] > 0 and report["coverage"] < 1.0
+
+
+def test_cached_answers_do_not_spend_the_call_budget():
+    budget = CallBudget(5)
+    graph, report = expand(find_queries(cached=("x", "y", "x a", "y a")), budget)
+    assert budget.calls == 5
+    assert report["expansions"] == 9
+
+
+def test_locations_share_one_call_budget():
+    budget = CallBudget(6)
+    _, first = expand(find_queries(), budget)
+    _, second = expand(find_queries(), budget)
+    assert first["expansions"] == 6 and second["expansions"] == 0
@@ -0,0 +1,93 @@
+import math
+import datetime
+import numpy as np
+import pytest
+
+from conftest import FakeTimelines, shares
+import simulate_keywords
+from google_client import GoogleClient
+from journal import Journal
+from timeline_store import TimelineStore
+
+
+def volume(term, day):
+    index = int(term[1:])
+    ordinal = datetime.date.fromisoformat(day).toordinal()
+    # A trend over the years, so windows far apart are scaled very differently
+    return (1 + index) * (1.5 + math.sin(ordinal / 11.0 + index)) * (1 + (ordinal % 1000) / 250.0)
+
+
+TERMS = ["t{}".format(index) for index in range(5)]
+
+
+def test_stitch_timelines_rescales_the_tail_on_shared_dates():
+    head = (["d1", "d2", "d3"], np.array([[1.0, 2.0, 3.0], [1.0, 1.0, 1.0]]))
+    tail = (["d2", "d3", "d4"], np.array([[4.0, 6.0, 8.0], [2.0, 2.0, 2.0]]))
+    dates, matrix = GoogleClient.stitch_timelines(head, tail)
+    assert dates == ["d1", "d2", "d3", "d4"]
+    assert matrix.tolist() == [[1.0, 2.0, 3.0, 4.0], [1.0, 1.0, 1.0, 1.0]]
+
+
+def test_date_shards_cover_the_range_with_overlap():
+    shards = GoogleClient._date_shards("2018-01-01", "2020-08-31")
+    assert shards[0][0] == "2018-01-01" and shards[-1][1] == "2020-08-31"
+    for (_, previous_end), (start, _) in zip(shards, shards[1:]):
+        overlap = datetime.date.fromisoformat(previous_end) - datetime.date.fromisoformat(start)
+        assert overlap.days + 1 == GoogleClient.TIMELINE_OVERLAP_DAYS
+
+
+def test_date_shards_keep_a_leap_year_in_one_window():
+    assert GoogleClient._date_shards("2020-01-01", "2020-12-31") == [("2020-01-01", "2020-12-31")]
+
+
+def test_date_shards_reject_a_range_that_ends_before_it_starts():
+    with pytest.raises(ValueError):
+        GoogleClient._date_shards("2020-02-01", "2020-01-01")
+
+
+def test_sharded_shares_match_a_single_request(client, geo, monkeypatch):
+    fake = FakeTimelines(volume)
+    monkeypatch.setattr(client, "_get_timelines_batch", fake)
+    sharded_dates, sharded = client.get_timelines_sharded(TERMS, geo, "2018-01-01", "2020-08-31")
+    assert len(fake.requests) == 3
+    single_dates, single = client.get_timelines_matrix(TERMS, geo, "2018-01-01", "2020-08-31")
+    assert sharded_dates == single_dates == FakeTimelines.days("2018-01-01", "2020-08-31")
+    np.testing.assert_allclose(shares(sharded), shares(single))
+    np.testing.assert_allclose(shares(sharded), shares(fake.true_matrix(TERMS, "2018-01-01", "2020-08-31")))
+
+
+def test_only_closed_windows_are_read_from_the_store(client, geo, monkeypatch, tmp_path):
+    fake = FakeTimelines(volume)
+    monkeypatch.setattr(client, "_get_timelines_batch", fake)
+    client.timeline_store = TimelineStore(str(tmp_path))
+    client.get_timelines_sharded(TERMS, geo, "2018-01-01", "2020-08-31")
+    requests = len(fake.requests)
+    client.get_timelines_sharded(TERMS, geo, "2018-01-01", "2020-08-31")
+    assert len(fake.requests) == requests
+
+    today = datetime.date.today()
+    startDate, endDate = (today - datetime.timedelta(days=500)).isoformat(), (today + datetime.timedelta(days=1)).isoformat()
+    client.get_timelines_sharded(TERMS, geo, startDate, endDate)
+    requests = len(fake.requests)
+    client.get_timelines_sharded(TERMS, geo, startDate, endDate)
+    # The first window has closed and comes from the store, the open one is fetched again
+    assert len(fake.requests) == requests + 1
+
+
+def test_incremental_timelines_fetch_only_the_new_tail(client, geo, monkeypatch, tmp_path):
+    fake = FakeTimelines(volume)
+    monkeypatch.setattr(client, "_get_timelines_batch", fake)
+    journal = Journal(str(tmp_path / "journal.jsonl"))
+
+    def simulation(endDate):
+        return simulate_keywords.Simulation(
+            "seed", geo, "2020-01", "2020-08", "2020-01-01", endDate, google_client=client, journal=journal, incremental=True
+        )
+
+    simulation("2020-06-30")._get_timelines(TERMS)
+    del fake.requests[:]
+    dates, matrix = simulation("2020-08-31")._get_timelines(TERMS)
+    overlap_start = datetime.date(2020, 6, 30) - datetime.timedelta(days=simulate_keywords.Simulation.TIMELINE_OVERLAP_DAYS)
+    assert [(startDate, endDate) for _, startDate, endDate in fake.requests] == [(overlap_start.isoformat(), "2020-08-31")]
+    assert dates == FakeTimelines.days("2020-01-01", "2020-08-31")
+    np.testing.assert_allclose(shares(matrix), shares(fake.true_matrix(TERMS, "2020-01-01", "2020-08-31")))
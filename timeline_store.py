@@ -0,0 +1,285 @@
+import os
+import json
+import logging
+import datetime
+import threading
+from urllib.parse import quote
+import numpy as np
+
+
+"""
+Parse a timeline point date, Google sends them like "Jan 05 2020"
+"""
+def parse_timeline_date(value):
+    for date_format in ("%b %d %Y", "%Y-%m-%d", "%Y-%m"):
+        try:
+            return datetime.datetime.strptime(value, date_format).date()
+        except ValueError:
+            continue
+    raise ValueError("Unknown timeline date format: {}".format(value))
+
+
+"""
+Read-only view of the raw timelines of one (geo, window): a float32 terms x dates matrix backed by a memory-mapped
+file, plus the term and date index. Aggregates are computed on demand over the mapped file, so nothing is loaded
+into memory until a view needs it and every view can be recomputed without calling the API again.
+"""
+class TimelineMatrix(object):
+
+    def __init__(self, path, terms, dates):
+        self.path = path
+        self.terms = terms
+        self.dates = dates
+        self.term_index = {term: row for row, term in enumerate(terms)}
+        self._matrix = None
+
+
+    @property
+    def matrix(self):
+        if self._matrix is None:
+            self._matrix = np.memmap(self.path, dtype=np.float32, mode="r", shape=(len(self.terms), len(self.dates)))
+        return self._matrix
+
+
+    """
+    Rows for TERMS (all terms when None), in the order given
+    """
+    def rows(self, terms=None):
+        if terms is None:
+            return self.matrix
+        return self.matrix[[self.term_index[term] for term in terms]]
+
+
+    """
+    Share of each of TERMS (every stored term when None) in their combined search volume. For the terms of one
+    request these are the numbers get_timelines_for_health returns.
+    """
+    def share(self, terms=None):
+        totals = self.rows(terms).sum(axis=1, dtype=np.float64)
+        grand_total = totals.sum()
+        return totals / grand_total if grand_total > 0 else totals
+
+
+    def mean(self, terms=None):
+        return self.rows(terms).mean(axis=1, dtype=np.float64)
+
+
+    """
+    Highest value of each term and the date it was reached
+    """
+    def peak(self, terms=None):
+        rows = self.rows(terms)
+        columns = rows.argmax(axis=1)
+        return rows[np.arange(len(columns)), columns], [self.dates[column] for column in columns]
+
+
+    """
+    Moving average over WINDOW points, one column per full window
+    """
+    def rolling(self, window, terms=None):
+        rows = np.asarray(self.rows(terms), dtype=np.float64)
+        cumulative = np.cumsum(np.pad(rows, ((0, 0), (1, 0))), axis=1)
+        return (cumulative[:, window:] - cumulative[:, :-window]) / window
+
+
+    """
+    Share of each of TERMS (every stored term when None) within every month (or year) of the window,
+    as (periods, terms x periods matrix)
+    """
+    def period_share(self, period="month", terms=None):
+        parsed = [parse_timeline_date(date) for date in self.dates]
+        labels = [date.strftime("%Y-%m" if period == "month" else "%Y") for date in parsed]
+        periods = list(dict.fromkeys(labels))
+        column_period = np.array([periods.index(label) for label in labels])
+        rows = np.asarray(self.rows(terms), dtype=np.float64)
+        sums = np.zeros((len(rows), len(periods)))
+        np.add.at(sums.T, column_period, rows.T)
+        totals = sums.sum(axis=0)
+        shares = np.divide(sums, totals, out=np.zeros_like(sums), where=totals > 0)
+        return periods, shares
+
+
+"""
+On-disk store of raw timelines, memory-mapped float32 matrices per (geo, window) under ROOT.
+Every matrix of a window holds terms on one scale: new terms are appended as rows at the end of the matrix they
+share terms with, rescaled on those, and known terms are overwritten in place. Terms that share nothing with a
+stored matrix start a new one next to it. A window fetched again with other dates (it was still open, or Google
+revised it) replaces the matrix it was written to.
+"""
+class TimelineStore(object):
+    ROOT = "output/timelines"
+
+    def __init__(self, root=ROOT):
+        self.root = root
+        self._lock = threading.Lock()
+
+
+    def _paths(self, geo, startDate, endDate, group=0):
+        directory = os.path.join(self.root, "geo=" + quote(geo, safe=""))
+        name = "{}_{}".format(startDate, endDate)
+        if group:
+            name += "-{}".format(group)
+        return directory, os.path.join(directory, name + ".float32"), os.path.join(directory, name + ".json")
+
+
+    def _read_index(self, index_path):
+        if not os.path.exists(index_path):
+            return None
+        with open(index_path, "r") as index_file:
+            return json.load(index_file)
+
+
+    """
+    (group, index) of every matrix stored for GEO and the window
+    """
+    def _groups(self, geo, startDate, endDate):
+        groups = []
+        while True:
+            index = self._read_index(self._paths(geo, startDate, endDate, len(groups))[2])
+            if index is None:
+                return groups
+            groups.append((len(groups), index))
+
+
+    """
+    Write PATH through a temporary file, so readers never see it half written
+    """
+    @staticmethod
+    def _replace(path, write, mode="w"):
+        temporary_path = path + ".tmp"
+        with open(temporary_path, mode) as temporary_file:
+            write(temporary_file)
+        os.replace(temporary_path, path)
+
+
+    def _write_index(self, index_path, index):
+        TimelineStore._replace(index_path, lambda index_file: json.dump(index, index_file))
+
+
+    """
+    (stored row, row of TERMS) of every one of TERMS that GROUP also holds with volume, when MATRIX has volume
+    for it too. Only those can carry a scale from one request to the other.
+    """
+    def _anchors(self, data_path, index, terms, matrix):
+        term_index = {term: row for row, term in enumerate(index["terms"])}
+        known = [(term_index[term], row) for row, term in enumerate(terms) if term in term_index]
+        if not known:
+            return []
+        stored = np.memmap(data_path, dtype=np.float32, mode="r", shape=(len(index["terms"]), len(index["dates"])))
+        stored_volumes = stored[[row for row, _ in known]].sum(axis=1, dtype=np.float64)
+        del stored
+        new_volumes = matrix[[row for _, row in known]].sum(axis=1, dtype=np.float64)
+        return [pair for pair, stored_volume, new_volume in zip(known, stored_volumes, new_volumes) if stored_volume > 0 and new_volume > 0]
+
+
+    """
+    Store the TERMS x DATES MATRIX of one request window for GEO.
+    Google scales every request on its own, so when some of TERMS are already stored with volume the new rows are
+    rescaled to match them, the same way batches are anchored in GoogleClient.get_timelines_matrix. Terms that are
+    zero on either side say nothing about the scale, so without any others the matrix is stored as a group of its own.
+    """
+    def put(self, geo, startDate, endDate, terms, dates, matrix):
+        matrix = np.asarray(matrix, dtype=np.float32)
+        with self._lock:
+            groups = self._groups(geo, startDate, endDate)
+            anchors, group, index = max(
+                [(self._anchors(self._paths(geo, startDate, endDate, group)[1], index, terms, matrix), group, index)
+                 for group, index in groups if index["dates"] == list(dates)] or [([], 0, None)],
+                key=lambda candidate: len(candidate[0])
+            )
+            if not anchors:
+                # Nothing to rescale on. A group of these terms stored with other dates is out of date and replaced,
+                # otherwise these terms get a matrix of their own
+                stale = [group for group, index in groups if index["dates"] != list(dates) and set(terms).intersection(index["terms"])]
+                if stale:
+                    logging.info("Timelines for {} {}..{} came back with other dates, the stored ones are replaced".format(geo, startDate, endDate))
+                group = stale[0] if stale else len(groups)
+                directory, data_path, index_path = self._paths(geo, startDate, endDate, group)
+                os.makedirs(directory, exist_ok=True)
+                TimelineStore._replace(data_path, lambda data_file: data_file.write(np.ascontiguousarray(matrix).tobytes()), "wb")
+                self._write_index(index_path, {"terms": list(terms), "dates": list(dates)})
+                return
+
+            directory, data_path, index_path = self._paths(geo, startDate, endDate, group)
+            term_index = {term: row for row, term in enumerate(index["terms"])}
+            known = [(term_index[term], row) for row, term in enumerate(terms) if term in term_index]
+            new = [row for row, term in enumerate(terms) if term not in term_index]
+            stored = np.memmap(data_path, dtype=np.float32, mode="r+", shape=(len(index["terms"]), len(dates)))
+            stored_volume = stored[[row for row, _ in anchors]].sum(dtype=np.float64)
+            new_volume = matrix[[row for _, row in anchors]].sum(dtype=np.float64)
+            matrix = matrix * np.float32(stored_volume / new_volume)
+            stored[[row for row, _ in known]] = matrix[[row for _, row in known]]
+            stored.flush()
+            del stored
+            if new:
+                # Rows are stored one after another, so new terms are an append to the end of the file
+                with open(data_path, "ab") as data_file:
+                    data_file.write(np.ascontiguousarray(matrix[new]).tobytes())
+                index["terms"].extend(terms[row] for row in new)
+                self._write_index(index_path, index)
+
+
+    """
+    TimelineMatrix for GEO and the window holding every one of TERMS (the first one stored when None),
+    or None if there is none
+    """
+    def get(self, geo, startDate, endDate, terms=None):
+        with self._lock:
+            groups = self._groups(geo, startDate, endDate)
+        for group, index in groups:
+            if terms is None or set(terms).issubset(index["terms"]):
+                return TimelineMatrix(self._paths(geo, startDate, endDate, group)[1], index["terms"], index["dates"])
+        return None
+
+
+"""
+Dense terms x geos x dates tensor of timelines, with the term, geo and date indexes.
+Google scales every geo on its own, so values are only comparable within a geo; share() puts every geo on
+the same footing as a distribution over the terms. Geos and dates Google had no data for are NaN.
+"""
+class TimelineTensor(object):
+
+    def __init__(self, terms, geos, dates, values):
+        self.terms = list(terms)
+        self.geos = list(geos)
+        self.dates = list(dates)
+        self.values = values
+        self.term_index = {term: index for index, term in enumerate(self.terms)}
+        self.geo_index = {geo: index for index, geo in enumerate(self.geos)}
+
+
+    """
+    Terms x dates matrix of one GEO
+    """
+    def geo(self, geo):
+        return self.values[:, self.geo_index[geo], :]
+
+
+    """
+    Geos x dates matrix of one TERM
+    """
+    def term(self, term):
+        return self.values[self.term_index[term]]
+
+
+    """
+    Terms x geos matrix of each term's share of the total volume of its geo, NaN for geos without data
+    """
+    def share(self):
+        totals = np.nansum(self.values, axis=2)
+        has_data = ~np.all(np.isnan(self.values), axis=(0, 2))
+        geo_totals = totals.sum(axis=0)
+        shares = np.divide(totals, geo_totals, out=np.zeros_like(totals), where=geo_totals > 0)
+        shares[:, ~has_data] = np.nan
+        return shares
+
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        np.savez_compressed(path, values=self.values, terms=np.array(self.terms), geos=np.array(self.geos), dates=np.array(self.dates))
+
+
+    @staticmethod
+    def load(path):
+        with np.load(path) as data:
+            return TimelineTensor(data["terms"].tolist(), data["geos"].tolist(), data["dates"].tolist(), data["values"])